@@ -1,14 +1,32 @@
-from collections import deque
+from collections import OrderedDict, deque
+import contextlib
+import copy
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.pool
 import random
 import sys
+from timeit import default_timer
+
+import numpy
 
 
 class Genome(object):
 
+    # An optional 'ScoreCache' shared by all genomes of the class
+    score_cache = None
+
     def __init__(self):
         self.__score = None
 
+    @classmethod
+    def create_initial_genomes(cls, count):
+        """ Returns 'count' genomes of an initial population. By default
+        they are created by the constructor. """
+        return [cls() for _ in xrange(count)]
+
     def cross(self, other):
         raise NotImplementedError()
 
@@ -18,12 +36,90 @@ class Genome(object):
     def evaluate(self):
         raise NotImplementedError()
 
+    @classmethod
+    def evaluate_batch(cls, genomes, fidelity=1.0, cutoff=None):
+        """ Evaluates several genomes at once and returns a list of their
+        scores. Subclasses can override this method to share work between
+        genomes. 'fidelity' is in (0, 1]; with a lower fidelity subclasses
+        may return cheaper approximations of scores of the same scale. If
+        'cutoff' is specified then subclasses may stop evaluation of genomes
+        which scores are certainly lower than it and return 'ScoreBound'
+        instances for them. """
+        return [genome.evaluate() for genome in genomes]
+
+    @classmethod
+    def refine(cls, genomes, step_count):
+        """ Returns locally improved copies of the evaluated genomes and the
+        number of evaluations made. A copy may be the genome itself if it
+        wasn't improved. Used by the local search of 'GeneticAlgorithm'. """
+        raise NotImplementedError()
+
+    def get_cache_key(self, resolution):
+        """ Returns a hashable key of the genome for the 'ScoreCache'. Genomes
+        which parameters differ by less than 'resolution' (relatively to
+        scales of parameters which are defined by the genome class) should
+        have equal keys. """
+        raise NotImplementedError()
+
+    # The array interface which is used by 'ArrayPopulation'. Genes of a
+    # genome are a vector of floats.
+
+    @classmethod
+    def random_genes(cls, count, random_state):
+        """ Returns a matrix with genes of 'count' random genomes """
+        raise NotImplementedError()
+
+    @classmethod
+    def mutate_genes(cls, genes, rate, random_state):
+        """ Applies the mutation operator to each row of 'genes'. Returns new
+        genes and a mask of mutated rows. """
+        raise NotImplementedError()
+
+    @classmethod
+    def cross_genes(cls, first_genes, second_genes, random_state):
+        """ Applies the crossover operator to pairs of rows of 'first_genes'
+        and 'second_genes'. Returns genes of first and second children. """
+        raise NotImplementedError()
+
+    @classmethod
+    def get_gene_bounds(cls):
+        """ Returns vectors of lower and upper bounds of genes """
+        raise NotImplementedError()
+
+    @classmethod
+    def repair_genes(cls, genes):
+        """ Returns genes with each row moved into the region of valid
+        genomes """
+        raise NotImplementedError()
+
+    @classmethod
+    def from_genes(cls, genes):
+        raise NotImplementedError()
+
+    def get_genes(self):
+        raise NotImplementedError()
+
+    @classmethod
+    def worker_initializer(cls):
+        """ Returns a pair '(initializer, arguments)' which prepares a worker
+        process to evaluate genomes of this class or None if no preparation is
+        required """
+        return None
+
     @property
     def score(self):
         if self.__score is None:
             self.__score = self.evaluate()
         return self.__score
 
+    @score.setter
+    def score(self, score):
+        self.__score = score
+
+    @property
+    def is_evaluated(self):
+        return self.__score is not None
+
     def reset_score(self):
         self.__score = None
 
@@ -31,14 +127,336 @@ class Genome(object):
 _genome_score = lambda genome: genome.score
 
 
+def _evaluate_genomes(genomes, fidelity=1.0, cutoff=None):
+    return type(genomes[0]).evaluate_batch(genomes, fidelity, cutoff)
+
+
+def _evaluate_chunk(arguments):
+    return _evaluate_genomes(*arguments)
+
+
+class ApproximateScore(float):
+    """ A score which was computed with a reduced fidelity. Such scores are
+    never stored in a 'ScoreCache'. """
+
+    __slots__ = ()
+
+
+class ScoreBound(ApproximateScore):
+    """ An upper bound of a score of a genome which evaluation was stopped
+    early because the genome can't reach a cutoff. 'skipped_count' is a
+    number of skipped evaluation steps, e.g. frames of a sound. """
+
+    def __new__(cls, score, skipped_count=0):
+        bound = ApproximateScore.__new__(cls, score)
+        bound.skipped_count = skipped_count
+        return bound
+
+    def __reduce__(self):
+        return ScoreBound, (float(self), self.skipped_count)
+
+
+class ScoreCache(object):
+    """ A bounded cache of genome scores. Genomes are keyed by
+    'Genome.get_cache_key(resolution)', so nearly identical genomes share a
+    score. The least recently used scores are evicted first.
+
+    A cache pays off only when a search produces many nearly identical
+    genomes. The genetic algorithm rarely does: evolving a partial of
+    'sounds/guitar.wav' for 60 generations reuses 1-2 of about 3750 scores
+    with the resolution 1e-3 and only 2% of them with the resolution 0.1. """
+
+    def __init__(self, capacity=4096, resolution=1e-3):
+        self.capacity = capacity
+        self.resolution = resolution
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+        self._scores = OrderedDict()
+
+    def get(self, key):
+        """ Returns a score for the specified key or None """
+        score = self._scores.pop(key, None)
+        if score is None:
+            self.miss_count += 1
+        else:
+            self.hit_count += 1
+            self._scores[key] = score
+        return score
+
+    def put(self, key, score):
+        self._scores.pop(key, None)
+        self._scores[key] = score
+        while len(self._scores) > self.capacity:
+            self._scores.popitem(last=False)
+            self.eviction_count += 1
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __str__(self):
+        return "%d hits, %d misses, %d evictions" % (
+            self.hit_count, self.miss_count, self.eviction_count)
+
+
+def evaluate_genomes(genomes, evaluator, cutoff=None):
+    """ Evaluates the specified genomes and assigns their scores. Scores are
+    taken from the 'score_cache' of the genome class when possible and
+    genomes with equal cache keys are evaluated once. Genomes which scores
+    are lower than 'cutoff' may get 'ScoreBound' scores. Returns the number
+    of genomes which were actually evaluated. """
+
+    if not genomes:
+        return 0
+
+    score_cache = type(genomes[0]).score_cache
+
+    if score_cache is None:
+        for genome, score in zip(
+                genomes, evaluator.evaluate(genomes, cutoff=cutoff)):
+            genome.score = score
+        return len(genomes)
+
+    genomes_by_key = OrderedDict()
+
+    for genome in genomes:
+        key = genome.get_cache_key(score_cache.resolution)
+        score = score_cache.get(key)
+        if score is None:
+            genomes_by_key.setdefault(key, []).append(genome)
+        else:
+            genome.score = score
+
+    if not genomes_by_key:
+        return 0
+
+    scores = evaluator.evaluate(
+        [key_genomes[0] for key_genomes in genomes_by_key.itervalues()],
+        cutoff=cutoff)
+
+    for (key, key_genomes), score in zip(genomes_by_key.iteritems(), scores):
+        if not isinstance(score, ApproximateScore):
+            score_cache.put(key, score)
+        for genome in key_genomes:
+            genome.score = score
+
+    return len(genomes_by_key)
+
+
+def _get_exact_best_genome(genomes):
+    """ Returns the best of the evaluated genomes and the number of
+    evaluations made. While the best genome has an 'ApproximateScore' it's
+    evaluated again with the full fidelity and without a cutoff, so the
+    returned score can be compared with exact scores. """
+
+    evaluation_count = 0
+
+    while True:
+        best_genome = max(genomes, key=_genome_score)
+        if not isinstance(best_genome.score, ApproximateScore):
+            return best_genome, evaluation_count
+        best_genome.reset_score()
+        evaluation_count += evaluate_genomes(
+            [best_genome], SerialEvaluator())
+
+
+class SerialEvaluator(object):
+    """ Evaluates genomes in the calling thread """
+
+    def evaluate(self, genomes, fidelity=1.0, cutoff=None):
+        return _evaluate_genomes(genomes, fidelity, cutoff)
+
+    def close(self):
+        pass
+
+
+class _PoolEvaluator(object):
+    """ Splits genomes into chunks and evaluates them using a pool of workers.
+    The pool is created on the first use and recreated when the class of
+    evaluated genomes changes, so workers are always prepared using the
+    'worker_initializer' of the current genome class. """
+
+    def __init__(self, workers=None):
+        self._workers = workers or multiprocessing.cpu_count()
+        self._pool = None
+        self._genome_class = None
+
+    def evaluate(self, genomes, fidelity=1.0, cutoff=None):
+
+        genome_class = type(genomes[0])
+
+        if genome_class is not self._genome_class:
+            self.close()
+            self._pool = self._create_pool(genome_class)
+            self._genome_class = genome_class
+
+        chunk_size = -(-len(genomes) // self._workers)
+        chunks = [
+            (genomes[start:start + chunk_size], fidelity, cutoff)
+            for start in xrange(0, len(genomes), chunk_size)]
+
+        return [
+            score for scores in self._pool.map(_evaluate_chunk, chunks)
+            for score in scores]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+        self._genome_class = None
+
+    def _create_pool(self, genome_class):
+        raise NotImplementedError()
+
+
+class ThreadPoolEvaluator(_PoolEvaluator):
+    """ Evaluates genomes in a pool of threads. This is useful only when the
+    evaluation code releases the GIL most of the time. """
+
+    def _create_pool(self, genome_class):
+        return multiprocessing.pool.ThreadPool(self._workers)
+
+
+class ProcessPoolEvaluator(_PoolEvaluator):
+    """ Evaluates genomes in a pool of processes. Genomes are sent to workers
+    for each evaluation, so they should be cheap to pickle; any heavy state
+    should be transferred once using 'Genome.worker_initializer'. """
+
+    def _create_pool(self, genome_class):
+        initializer, arguments = (
+            genome_class.worker_initializer() or (None, ()))
+        return multiprocessing.Pool(self._workers, initializer, arguments)
+
+
+class MultiFidelityEvaluator(object):
+    """ Evaluates genomes using successive halving. 'schedule' is a sequence
+    of pairs '(fidelity, promotion_rate)': at each stage the remaining
+    genomes are evaluated with the given fidelity and only the best
+    'promotion_rate' of them are promoted to the next stage. Promoted genomes
+    are finally evaluated with the full fidelity. Other genomes keep their
+    last scores which are 'ApproximateScore' instances; populations evaluate
+    such a genome again when it becomes the best one. Evaluation itself is
+    performed by 'evaluator'. """
+
+    def __init__(self, evaluator=None, schedule=((0.25, 0.5),)):
+        self.evaluator = evaluator or SerialEvaluator()
+        self.schedule = list(schedule)
+        # Numbers of evaluations by fidelity
+        self.evaluation_counts = {}
+
+    def evaluate(self, genomes, fidelity=1.0, cutoff=None):
+
+        scores = [None] * len(genomes)
+        candidates = range(len(genomes))
+
+        for stage_fidelity, promotion_rate in self.schedule:
+            for index, score in zip(candidates, self._evaluate(
+                    genomes, candidates, stage_fidelity * fidelity, cutoff)):
+                scores[index] = ApproximateScore(score)
+            candidates.sort(key=scores.__getitem__, reverse=True)
+            del candidates[
+                int(math.ceil(len(candidates) * promotion_rate)):]
+
+        for index, score in zip(candidates, self._evaluate(
+                genomes, candidates, fidelity, cutoff)):
+            scores[index] = score
+
+        return scores
+
+    def close(self):
+        self.evaluator.close()
+
+    def _evaluate(self, genomes, indices, fidelity, cutoff):
+        if not indices:
+            return []
+        self.evaluation_counts[fidelity] = (
+            self.evaluation_counts.get(fidelity, 0) + len(indices))
+        return self.evaluator.evaluate(
+            [genomes[index] for index in indices], fidelity, cutoff)
+
+
+# A number of genomes which are evaluated with the same cutoff
+_cutoff_chunk_size = 16
+
+
+def _evaluate_with_cutoff(genomes, evaluator, scores, selected_count):
+    """ Evaluates genomes of a population which 'selected_count' best genomes
+    will be selected. 'scores' are scores of other genomes of the population.
+    Genomes are evaluated in chunks, and each chunk gets the cutoff below
+    which genomes can't be selected given exact scores which are already
+    known. Returns the number of genomes which were actually evaluated. """
+
+    exact_scores = [
+        score for score in scores if not isinstance(score, ApproximateScore)]
+
+    evaluation_count = 0
+    start = 0
+
+    while start < len(genomes):
+
+        cutoff = None
+        if selected_count and len(exact_scores) >= selected_count:
+            exact_scores.sort(reverse=True)
+            cutoff = exact_scores[selected_count - 1]
+
+        end = start + max(
+            selected_count - len(exact_scores), _cutoff_chunk_size)
+        chunk = genomes[start:end]
+        start = end
+
+        evaluation_count += evaluate_genomes(chunk, evaluator, cutoff)
+        exact_scores.extend(
+            genome.score for genome in chunk
+            if not isinstance(genome.score, ApproximateScore))
+
+    return evaluation_count
+
+
 class Population(object):
 
-    def __init__(self, genome_factory, size):
+    def __init__(self, genome_class, size, evaluator=None):
         self._generation_count = 0
         self._size = size
-        self._genomes = [genome_factory() for _ in xrange(size)]
+        self._genomes = genome_class.create_initial_genomes(size)
+        self.evaluator = evaluator or SerialEvaluator()
+        self.evaluation_count = 0
+        self.reused_score_count = 0
+        self.aborted_evaluation_count = 0
+        self.skipped_step_count = 0
+
+    def evaluate(self, selection_rate=None):
+        """ Evaluates all genomes which have no score yet using the population
+        evaluator. If 'selection_rate' is specified then evaluation of
+        genomes which certainly won't be selected with this rate may be
+        stopped early; scores of such genomes are 'ScoreBound' instances. """
+
+        genomes = [
+            genome for genome in self._genomes if not genome.is_evaluated]
+
+        if selection_rate is None:
+            evaluation_count = evaluate_genomes(genomes, self.evaluator)
+        else:
+            evaluation_count = _evaluate_with_cutoff(
+                genomes, self.evaluator,
+                [genome.score for genome in self._genomes
+                 if genome.is_evaluated],
+                int(self._size * selection_rate))
+        self.evaluation_count += evaluation_count
+        self.reused_score_count += len(genomes) - evaluation_count
+
+        for genome in genomes:
+            if isinstance(genome.score, ScoreBound):
+                self.aborted_evaluation_count += 1
+                self.skipped_step_count += genome.score.skipped_count
+
+    @property
+    def scores(self):
+        self.evaluate()
+        return [genome.score for genome in self._genomes]
 
     def select(self, selection_rate):
+        self.evaluate()
         selected_count = int(self._size * selection_rate)
         self._genomes.sort(key=_genome_score, reverse=True)
         self._genomes = self._genomes[:selected_count]
@@ -75,10 +493,28 @@ class Population(object):
 
     @property
     def best_genome(self):
-        return max(self._genomes, key=_genome_score)
+        """ The best genome which score is exact (see
+        '_get_exact_best_genome') """
+        self.evaluate()
+        best_genome, evaluation_count = _get_exact_best_genome(self._genomes)
+        self.evaluation_count += evaluation_count
+        return best_genome
+
+    def get_best_genomes(self, count):
+        self.evaluate()
+        return sorted(self._genomes, key=_genome_score, reverse=True)[:count]
+
+    def replace_worst_genomes(self, genomes):
+        """ Replaces the worst genomes of the population with the specified
+        ones """
+        if not genomes:
+            return
+        self.evaluate()
+        self._genomes.sort(key=_genome_score, reverse=True)
+        self._genomes[-len(genomes):] = genomes[:self._size]
 
     def output_statistics(self):
-        scores = list(genome.score for genome in self._genomes)
+        scores = self.scores
         best_score = max(scores)
         worst_score = min(scores)
         mean_score = sum(scores) / float(self._size)
@@ -87,6 +523,347 @@ class Population(object):
             self._generation_count, best_score, worst_score, mean_score)
 
 
+class ArrayPopulation(object):
+    """ A population which stores genes of all genomes in a single matrix and
+    applies genetic operators to all genomes at once. The genome class must
+    implement the array interface of 'Genome'. Genome objects are created
+    only to be evaluated and to be returned by 'best_genome'.
+
+    The population has the same interface and behavior as 'Population', but
+    random numbers are taken from its own 'numpy.random.RandomState' seeded
+    with 'seed'. """
+
+    def __init__(self, genome_class, size, evaluator=None, seed=None):
+        self._genome_class = genome_class
+        self._generation_count = 0
+        self._size = size
+        self._random_state = numpy.random.RandomState(seed)
+        self._genes = genome_class.random_genes(size, self._random_state)
+        self._scores = numpy.full(size, numpy.nan)
+        # A mask of scores which aren't 'ApproximateScore' instances
+        self._exact = numpy.zeros(size, dtype=bool)
+        self.evaluator = evaluator or SerialEvaluator()
+        self.evaluation_count = 0
+        self.reused_score_count = 0
+        self.aborted_evaluation_count = 0
+        self.skipped_step_count = 0
+
+    def evaluate(self, selection_rate=None):
+        """ Evaluates all genomes which have no score yet using the population
+        evaluator. See 'Population.evaluate'. """
+
+        unscored = numpy.flatnonzero(numpy.isnan(self._scores))
+        genomes = [
+            self._genome_class.from_genes(genes)
+            for genes in self._genes[unscored]]
+
+        if selection_rate is None:
+            evaluation_count = evaluate_genomes(genomes, self.evaluator)
+        else:
+            evaluation_count = _evaluate_with_cutoff(
+                genomes, self.evaluator, list(self._scores[self._exact]),
+                int(self._size * selection_rate))
+        self.evaluation_count += evaluation_count
+        self.reused_score_count += len(genomes) - evaluation_count
+
+        scores = [genome.score for genome in genomes]
+        self._scores[unscored] = scores
+        self._exact[unscored] = [
+            not isinstance(score, ApproximateScore) for score in scores]
+
+        for score in scores:
+            if isinstance(score, ScoreBound):
+                self.aborted_evaluation_count += 1
+                self.skipped_step_count += score.skipped_count
+
+    @property
+    def scores(self):
+        self.evaluate()
+        return self._scores.copy()
+
+    def select(self, selection_rate):
+        self.evaluate()
+        selected_count = int(self._size * selection_rate)
+        order = numpy.argsort(-self._scores, kind="mergesort")[:selected_count]
+        self._genes = self._genes[order]
+        self._scores = self._scores[order]
+        self._exact = self._exact[order]
+
+    def crossbreed(self):
+
+        survivor_count = len(self._genes)
+        breed_count = self._size - survivor_count
+
+        if breed_count <= 0:
+            return
+
+        # Parents of a pair must be distinct survivors
+        assert survivor_count >= 2, \
+            "Crossbreeding requires at least two survivors"
+
+        # Uses tournament selection algorithm. A tournament of all survivors
+        # is always won by the best one, so tournaments are smaller.
+        tournament_size = min(4, survivor_count - 1)
+
+        first_parents = []
+        second_parents = []
+        pair_count = 0
+
+        while 2 * pair_count < breed_count:
+
+            tournament_count = (breed_count + 1) // 2 - pair_count
+
+            # Survivors are sorted by score, so a winner of a tournament is a
+            # participant with the lowest index
+            first_winners, second_winners = (
+                self._random_state.rand(tournament_count, survivor_count)
+                    .argsort(axis=1)[:, :tournament_size].min(axis=1)
+                for _ in xrange(2))
+
+            distinct = first_winners != second_winners
+            first_parents.append(first_winners[distinct])
+            second_parents.append(second_winners[distinct])
+            pair_count += numpy.count_nonzero(distinct)
+
+        first_children, second_children = self._genome_class.cross_genes(
+            self._genes[numpy.concatenate(first_parents)],
+            self._genes[numpy.concatenate(second_parents)],
+            self._random_state)
+
+        breed = numpy.stack((first_children, second_children), axis=1)
+        breed = breed.reshape(-1, self._genes.shape[1])[:breed_count]
+
+        self._genes = numpy.vstack((self._genes, breed))
+        self._scores = numpy.concatenate(
+            (self._scores, numpy.full(len(breed), numpy.nan)))
+        self._exact = numpy.concatenate(
+            (self._exact, numpy.zeros(len(breed), dtype=bool)))
+
+    def mutate(self, mutation_rate, elitism_rate):
+        elite_count = int(self._size * elitism_rate)
+        genes, mutated = self._genome_class.mutate_genes(
+            self._genes[elite_count:], mutation_rate, self._random_state)
+        self._genes[elite_count:] = genes
+        self._scores[elite_count:][mutated] = numpy.nan
+        self._exact[elite_count:][mutated] = False
+
+    def advance_generation(self):
+        self._generation_count += 1
+
+    @property
+    def best_genome(self):
+        """ The best genome which score is exact (see
+        '_get_exact_best_genome') """
+
+        self.evaluate()
+
+        while True:
+            index = numpy.argmax(self._scores)
+            genome = self._get_genome(index)
+            if self._exact[index]:
+                return genome
+            genome.reset_score()
+            self.evaluation_count += evaluate_genomes(
+                [genome], SerialEvaluator())
+            self._scores[index] = genome.score
+            self._exact[index] = True
+
+    def get_best_genomes(self, count):
+        self.evaluate()
+        return [
+            self._get_genome(index) for index in
+            numpy.argsort(-self._scores, kind="mergesort")[:count]]
+
+    def replace_worst_genomes(self, genomes):
+        """ Replaces the worst genomes of the population with the specified
+        ones """
+        if not genomes:
+            return
+        self.evaluate()
+        genomes = genomes[:self._size]
+        worst = numpy.argsort(-self._scores, kind="mergesort")[-len(genomes):]
+        self._genes[worst] = [genome.get_genes() for genome in genomes]
+        self._scores[worst] = [
+            genome.score if genome.is_evaluated else numpy.nan
+            for genome in genomes]
+        self._exact[worst] = [
+            genome.is_evaluated and
+                not isinstance(genome.score, ApproximateScore)
+            for genome in genomes]
+
+    def _get_genome(self, index):
+        genome = self._genome_class.from_genes(self._genes[index])
+        genome.score = (
+            self._scores[index] if self._exact[index] else
+            ApproximateScore(self._scores[index]))
+        return genome
+
+    def output_statistics(self):
+        scores = self.scores
+        logger.info(
+            "Generation %d. Best: %.2f. Worst: %.2f. Mean: %.2f",
+            self._generation_count, scores.max(), scores.min(), scores.mean())
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exception_type, exception, traceback):
+        pass
+
+
+class _NullInstrumentation(object):
+    """ Used when instrumentation is disabled, does nothing """
+
+    _phase = _NullPhase()
+
+    def start_run(self, population):
+        pass
+
+    def phase(self, name):
+        return self._phase
+
+    def end_generation(self, population):
+        pass
+
+    def end_run(self, population, stop_reason):
+        pass
+
+    def add_refinement_gain(self, gain):
+        pass
+
+
+def _get_counters(population, initial_counters=None):
+    """ Returns counters of the population work, optionally relatively to
+    previously taken 'initial_counters' """
+    counters = {
+        "evaluations": population.evaluation_count,
+        "reused_scores": population.reused_score_count,
+        "aborted_evaluations": population.aborted_evaluation_count,
+        "skipped_steps": population.skipped_step_count
+    }
+    if initial_counters:
+        for name in counters:
+            counters[name] -= initial_counters[name]
+    return counters
+
+
+class Instrumentation(object):
+    """ Collects metrics of 'GeneticAlgorithm.run': wall time of each phase
+    of a generation, numbers of evaluations, of reused scores (cache hits)
+    and of aborted evaluations, score gains of the local search and the
+    number of generations. After each generation and after the run a
+    record (a dict) is passed to each of 'callbacks'. Items of 'context' are
+    added to all records, so a caller can label runs. """
+
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.context = {}
+
+    def start_run(self, population):
+        self._run_start_time = default_timer()
+        self._run_phase_times = {}
+        self._generation_count = 0
+        self._best_score = None
+        self._convergence_generation = 0
+        self._run_refinement_gain = 0.0
+        self._initial_counters = _get_counters(population)
+        self._start_generation(population)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = default_timer()
+        try:
+            yield
+        finally:
+            self._phase_times[name] = (
+                self._phase_times.get(name, 0) + default_timer() - start_time)
+
+    def add_refinement_gain(self, gain):
+        self._refinement_gain += gain
+        self._run_refinement_gain += gain
+
+    def end_generation(self, population):
+
+        self._generation_count += 1
+
+        scores = population.scores
+        best_score = float(max(scores))
+
+        if self._best_score is None or best_score > self._best_score:
+            self._best_score = best_score
+            self._convergence_generation = self._generation_count
+
+        for name, time in self._phase_times.iteritems():
+            self._run_phase_times[name] = (
+                self._run_phase_times.get(name, 0) + time)
+
+        record = {
+            "event": "generation",
+            "generation": self._generation_count,
+            "best_score": best_score,
+            "mean_score": float(sum(scores)) / len(scores),
+            "worst_score": float(min(scores)),
+            "phase_times": self._phase_times,
+            "refinement_gain": self._refinement_gain,
+            "time": default_timer() - self._generation_start_time
+        }
+        record.update(_get_counters(population, self._generation_counters))
+        self._emit(record)
+
+        self._start_generation(population)
+
+    def end_run(self, population, stop_reason):
+        record = {
+            "event": "run",
+            "generations": self._generation_count,
+            "convergence_generation": self._convergence_generation,
+            "stop_reason": stop_reason,
+            "best_score": self._best_score,
+            "phase_times": self._run_phase_times,
+            "refinement_gain": self._run_refinement_gain,
+            "time": default_timer() - self._run_start_time
+        }
+        record.update(_get_counters(population, self._initial_counters))
+        self._emit(record)
+
+    def close(self):
+        for callback in self.callbacks:
+            if hasattr(callback, "close"):
+                callback.close()
+
+    def _start_generation(self, population):
+        self._generation_start_time = default_timer()
+        self._generation_counters = _get_counters(population)
+        self._phase_times = {}
+        self._refinement_gain = 0.0
+
+    def _emit(self, record):
+        record.update(self.context)
+        for callback in self.callbacks:
+            callback(record)
+
+
+class JsonLinesSink(object):
+    """ An instrumentation callback which appends records to a file, one JSON
+    object per line """
+
+    def __init__(self, filename):
+        self._file = open(filename, "a")
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+_null_instrumentation = _NullInstrumentation()
+
+
 class GeneticAlgorithm(object):
 
     def __init__(self):
@@ -97,21 +874,56 @@ class GeneticAlgorithm(object):
         self.mutation_rate = 0.25
         self.elitism_rate = 0.15
         self.mutation_decrease_rate = 0.01
+        self.instrumentation = None
+        # Stop evaluation of genomes which can't be selected
+        self.early_abort = False
+        # Every 'refinement_interval' generations (never if 0) the best
+        # genomes are improved by 'Genome.refine' and their improved copies
+        # replace the worst genomes
+        self.refinement_interval = 0
+        self.refinement_count = 4
+        self.refinement_step_count = 5
 
-    def run(self, population):
+    def run(self, population, evaluator=None):
+
+        if evaluator is not None:
+            population.evaluator = evaluator
+
+        instrumentation = self.instrumentation or _null_instrumentation
+        instrumentation.start_run(population)
 
         current_mutation_rate = self.mutation_rate
 
         last_generations_scores = deque()
 
+        stop_reason = "generation_limit"
+
+        cutoff_rate = self.selection_rate if self.early_abort else None
+
         for generation_index in xrange(self.generation_limit):
 
-            population.select(self.selection_rate)
-            population.crossbreed()
-            population.mutate(current_mutation_rate, self.elitism_rate)
+            # Evaluation is performed explicitly, so it's measured separately
+            # from the phases which trigger it
+            with instrumentation.phase("evaluate"):
+                population.evaluate(cutoff_rate)
+            with instrumentation.phase("select"):
+                population.select(self.selection_rate)
+            with instrumentation.phase("crossbreed"):
+                population.crossbreed()
+            with instrumentation.phase("mutate"):
+                population.mutate(current_mutation_rate, self.elitism_rate)
             population.advance_generation()
 
-            population.output_statistics()
+            with instrumentation.phase("evaluate"):
+                population.evaluate(cutoff_rate)
+            if (self.refinement_interval and
+                    (generation_index + 1) % self.refinement_interval == 0):
+                with instrumentation.phase("refine"):
+                    self._refine(population, instrumentation)
+            with instrumentation.phase("statistics"):
+                population.output_statistics()
+
+            instrumentation.end_generation(population)
 
             last_generations_scores.append(population.best_genome.score)
 
@@ -120,12 +932,530 @@ class GeneticAlgorithm(object):
                 score_improvement = (population.best_genome.score -
                     last_generations_scores.popleft())
                 if score_improvement < self.score_improvement_threshold:
+                    stop_reason = "no_improvement"
                     break
 
             current_mutation_rate *= 1 - self.mutation_decrease_rate
 
+        instrumentation.end_run(population, stop_reason)
+
         return population.best_genome
 
+    def _refine(self, population, instrumentation):
+
+        genomes = population.get_best_genomes(self.refinement_count)
+
+        refined_genomes, evaluation_count = type(genomes[0]).refine(
+            genomes, self.refinement_step_count)
+        population.evaluation_count += evaluation_count
+
+        improved_genomes = [
+            refined_genome
+            for genome, refined_genome in zip(genomes, refined_genomes)
+            if refined_genome.score > genome.score]
+        population.replace_worst_genomes(improved_genomes)
+
+        # The gain of the best score
+        gain = max(
+            max(genome.score for genome in refined_genomes) - genomes[0].score,
+            0)
+        instrumentation.add_refinement_gain(gain)
+
+        logger.info(
+            "Refinement. Improved: %d of %d. Gain: %.2f",
+            len(improved_genomes), len(genomes), gain)
+
+
+class _AskTellPopulation(object):
+    """ Genomes of the current generation of an ask/tell optimizer. Genes
+    are normalized, so each gene is in [0, 1]. The first generation consists
+    of genomes of 'population' (a 'Population' or an 'ArrayPopulation')
+    which evaluator and counters are taken over; its normalized genes are
+    'first_genes'. Provides the interface which 'Instrumentation' expects
+    from populations. """
+
+    def __init__(self, population):
+
+        genomes = population.get_best_genomes(len(population.scores))
+
+        self._genome_class = type(genomes[0])
+        self._lower_bounds, upper_bounds = self._genome_class.get_gene_bounds()
+        self._ranges = numpy.where(
+            upper_bounds > self._lower_bounds,
+            upper_bounds - self._lower_bounds, 1)
+
+        self._generation_count = 0
+        self.evaluator = population.evaluator
+        self.best_genome = None
+        self.evaluation_count = population.evaluation_count
+        self.reused_score_count = population.reused_score_count
+        self.aborted_evaluation_count = population.aborted_evaluation_count
+        self.skipped_step_count = population.skipped_step_count
+
+        self.first_genes = (numpy.array(
+            [genome.get_genes() for genome in genomes]) -
+            self._lower_bounds) / self._ranges
+        self._set_generation(genomes)
+
+    def evaluate(self, normalized_genes):
+        """ Evaluates genomes with repaired copies of the specified genes
+        and returns their scores """
+
+        genes = self._genome_class.repair_genes(
+            self._lower_bounds + normalized_genes * self._ranges)
+        genomes = [self._genome_class.from_genes(row) for row in genes]
+
+        evaluation_count = evaluate_genomes(genomes, self.evaluator)
+        self.evaluation_count += evaluation_count
+        self.reused_score_count += len(genomes) - evaluation_count
+
+        return self._set_generation(genomes)
+
+    def _set_generation(self, genomes):
+
+        best_genome, evaluation_count = _get_exact_best_genome(genomes)
+        self.evaluation_count += evaluation_count
+        if (self.best_genome is None or
+                best_genome.score > self.best_genome.score):
+            self.best_genome = best_genome
+
+        self._scores = numpy.array([genome.score for genome in genomes])
+        return self._scores
+
+    @property
+    def scores(self):
+        return self._scores
+
+    def advance_generation(self):
+        self._generation_count += 1
+
+    def output_statistics(self):
+        logger.info(
+            "Generation %d. Best: %.2f. Worst: %.2f. Mean: %.2f",
+            self._generation_count, self.best_genome.score,
+            self._scores.min(), self._scores.mean())
+
+
+class _AskTellAlgorithm(object):
+    """ A base of optimizers which work with genes of genomes directly (see
+    the array interface of 'Genome'). Genes are normalized, so each gene is
+    in [0, 1]. The optimizer suggests genes of a generation ('_ask') and
+    then updates its state using their scores ('_tell'). Copies of suggested
+    genes are repaired for evaluation, but the optimizer is told the
+    suggested genes themselves: repairing may reorder genes (e.g. sort
+    envelope points of sounds), which would break the correspondence of
+    genes and the optimizer state.
+
+    Stopping rules, logging and instrumentation are the same as the ones of
+    'GeneticAlgorithm', and 'run' takes the same populations. Genomes of the
+    population are the first generation. Random numbers are taken from a
+    'numpy.random.RandomState' seeded from the 'random' module. """
+
+    def __init__(self):
+        self.generation_limit = sys.maxint
+        self.generations_without_improvement_limit = 30
+        self.score_improvement_threshold = 100
+        self.instrumentation = None
+
+    def run(self, population, evaluator=None):
+
+        if evaluator is not None:
+            population.evaluator = evaluator
+
+        random_state = numpy.random.RandomState(random.getrandbits(32))
+
+        instrumentation = self.instrumentation or _null_instrumentation
+        instrumentation.start_run(population)
+
+        last_generations_scores = deque()
+
+        stop_reason = "generation_limit"
+
+        for generation_index in xrange(self.generation_limit):
+
+            if generation_index:
+                with instrumentation.phase("ask"):
+                    genes = self._ask(random_state)
+                with instrumentation.phase("evaluate"):
+                    scores = population.evaluate(genes)
+                with instrumentation.phase("tell"):
+                    self._tell(genes, scores)
+            else:
+                with instrumentation.phase("evaluate"):
+                    population = _AskTellPopulation(population)
+                with instrumentation.phase("tell"):
+                    self._start(population.first_genes, population.scores)
+            population.advance_generation()
+
+            with instrumentation.phase("statistics"):
+                population.output_statistics()
+
+            instrumentation.end_generation(population)
+
+            last_generations_scores.append(population.best_genome.score)
+
+            if len(last_generations_scores) ==\
+                    self.generations_without_improvement_limit:
+                score_improvement = (population.best_genome.score -
+                    last_generations_scores.popleft())
+                if score_improvement < self.score_improvement_threshold:
+                    stop_reason = "no_improvement"
+                    break
+
+        instrumentation.end_run(population, stop_reason)
+
+        return population.best_genome
+
+    def _start(self, genes, scores):
+        """ Initializes the optimizer with the first generation """
+        raise NotImplementedError()
+
+    def _ask(self, random_state):
+        raise NotImplementedError()
+
+    def _tell(self, genes, scores):
+        raise NotImplementedError()
+
+
+class CmaEvolutionStrategy(_AskTellAlgorithm):
+    """ The covariance matrix adaptation evolution strategy (CMA-ES). The
+    search starts at the best genome of the first generation and its initial
+    distribution follows the spread of genes of the best genomes. The
+    strategy is a local search, so it works best with genomes initialized
+    near optima (e.g. sounds seeded near spectral peaks). 'offspring_count'
+    genomes are sampled in each generation, by default their number depends
+    on the number of genes. """
+
+    def __init__(self, offspring_count=None):
+        _AskTellAlgorithm.__init__(self)
+        self.offspring_count = offspring_count
+
+    def _start(self, genes, scores):
+
+        dimension = genes.shape[1]
+
+        self._offspring_count = (
+            self.offspring_count or 4 + int(3 * numpy.log(dimension)))
+
+        parent_count = self._offspring_count // 2
+        weights = (
+            numpy.log(parent_count + 0.5) -
+            numpy.log(numpy.arange(1, parent_count + 1)))
+        self._weights = weights / weights.sum()
+        effective_count = 1 / numpy.sum(self._weights ** 2)
+        self._effective_count = effective_count
+
+        # Learning rates and the damping of the step size adaptation
+        self._path_rate = (4 + effective_count / dimension) / (
+            dimension + 4 + 2 * effective_count / dimension)
+        self._step_path_rate = (effective_count + 2) / (
+            dimension + effective_count + 5)
+        self._rank_one_rate = 2 / ((dimension + 1.3) ** 2 + effective_count)
+        self._rank_parents_rate = min(
+            1 - self._rank_one_rate,
+            2 * (effective_count - 2 + 1 / effective_count) /
+                ((dimension + 2) ** 2 + effective_count))
+        self._step_damping = 1 + self._step_path_rate + 2 * max(
+            0, numpy.sqrt((effective_count - 1) / (dimension + 1)) - 1)
+        # An expected length of a normally distributed vector
+        self._expected_length = numpy.sqrt(dimension) * (
+            1 - 1. / (4 * dimension) + 1. / (21 * dimension ** 2))
+
+        # The search starts at the best genome with a spread of genes of the
+        # best genomes
+        elite = genes[numpy.argsort(-scores, kind="mergesort")[
+            :parent_count]]
+        deviations = numpy.maximum(elite.std(axis=0), 1e-3)
+        self._mean = elite[0].copy()
+        self._step_size = numpy.exp(numpy.log(deviations).mean())
+        self._scales = deviations / self._step_size
+        self._covariance = numpy.diag(self._scales ** 2)
+        self._axes = numpy.eye(dimension)
+        self._path = numpy.zeros(dimension)
+        self._step_path = numpy.zeros(dimension)
+        self._generation_count = 0
+
+    def _ask(self, random_state):
+        steps = random_state.standard_normal(
+            (self._offspring_count, len(self._mean)))
+        return self._mean + self._step_size * (steps * self._scales).dot(
+            self._axes.T)
+
+    def _tell(self, genes, scores):
+
+        self._generation_count += 1
+
+        parents = genes[numpy.argsort(-scores, kind="mergesort")[
+            :len(self._weights)]]
+        steps = (parents - self._mean) / self._step_size
+        mean_step = self._weights.dot(steps)
+
+        self._mean = self._mean + self._step_size * mean_step
+
+        # Evolution paths
+        whitened_step = self._axes.dot(
+            self._axes.T.dot(mean_step) / self._scales)
+        self._step_path = (
+            (1 - self._step_path_rate) * self._step_path +
+            numpy.sqrt(
+                self._step_path_rate * (2 - self._step_path_rate) *
+                self._effective_count) * whitened_step)
+
+        step_path_length = numpy.linalg.norm(self._step_path)
+        stalled = step_path_length / numpy.sqrt(
+            1 - (1 - self._step_path_rate) ** (2 * self._generation_count)
+        ) / self._expected_length >= 1.4 + 2. / (len(self._mean) + 1)
+
+        self._path = (1 - self._path_rate) * self._path
+        if not stalled:
+            self._path += numpy.sqrt(
+                self._path_rate * (2 - self._path_rate) *
+                self._effective_count) * mean_step
+
+        # Covariance matrix and step size
+        self._covariance = (
+            (1 - self._rank_one_rate - self._rank_parents_rate) *
+                self._covariance +
+            self._rank_one_rate * (
+                numpy.outer(self._path, self._path) +
+                stalled * self._path_rate * (2 - self._path_rate) *
+                    self._covariance) +
+            self._rank_parents_rate * (steps.T * self._weights).dot(steps))
+
+        self._step_size *= numpy.exp(
+            self._step_path_rate / self._step_damping *
+            (step_path_length / self._expected_length - 1))
+
+        variances, self._axes = numpy.linalg.eigh(self._covariance)
+        self._scales = numpy.sqrt(numpy.maximum(variances, 1e-20))
+
+
+class DifferentialEvolution(_AskTellAlgorithm):
+    """ Differential evolution with the "current-to-best/1/bin" strategy.
+    The population consists of 'population_size' best genomes of the first
+    generation. Each genome produces a trial genome which replaces it when
+    it's not worse. """
+
+    def __init__(self, population_size=30, differential_weight=0.7,
+                 crossover_rate=0.9):
+        _AskTellAlgorithm.__init__(self)
+        self.population_size = population_size
+        self.differential_weight = differential_weight
+        self.crossover_rate = crossover_rate
+
+    def _start(self, genes, scores):
+        best = numpy.argsort(-scores, kind="mergesort")[:self.population_size]
+        self._genes = genes[best]
+        self._scores = scores[best]
+
+    def _ask(self, random_state):
+
+        count, dimension = self._genes.shape
+
+        # Two distinct random genomes other than the current one
+        others = random_state.rand(count, count - 1).argsort(axis=1)[:, :2]
+        others += others >= numpy.arange(count)[:, numpy.newaxis]
+
+        best_genes = self._genes[numpy.argmax(self._scores)]
+
+        mutants = self._genes + self.differential_weight * (
+            best_genes - self._genes +
+            self._genes[others[:, 0]] - self._genes[others[:, 1]])
+
+        crossed = random_state.rand(count, dimension) < self.crossover_rate
+        crossed[numpy.arange(count), random_state.randint(
+            dimension, size=count)] = True
+
+        return numpy.where(crossed, mutants, self._genes)
+
+    def _tell(self, genes, scores):
+        improved = scores >= self._scores
+        self._genes[improved] = genes[improved]
+        self._scores[improved] = scores[improved]
+
+
+def _run_island(connection, initializer, arguments):
+    """ Evolves a population of an island in a worker process. Commands are
+    received from 'connection'. """
+
+    if initializer:
+        initializer(*arguments)
+
+    # Progress is logged by the main process
+    logger.setLevel(logging.WARNING)
+
+    (prototype, population_class, population_size, algorithm, migrant_count,
+     seed) = connection.recv()
+
+    random.seed(seed)
+
+    if issubclass(population_class, ArrayPopulation):
+        population = population_class(
+            type(prototype), population_size, seed=seed)
+    else:
+        population = population_class(type(prototype), population_size)
+
+    while True:
+
+        command, arguments = connection.recv()
+
+        if command == "stop":
+            connection.send(population.best_genome)
+            return
+
+        (algorithm.generation_limit, algorithm.mutation_rate,
+         immigrants) = arguments
+
+        population.replace_worst_genomes(immigrants)
+        algorithm.run(population)
+
+        # The best score is sent separately, because there may be no migrants
+        connection.send((
+            population.best_genome.score,
+            population.get_best_genomes(migrant_count)))
+
+
+class IslandModel(object):
+    """ Runs the genetic algorithm on several populations (islands) which
+    evolve in parallel processes. Every 'migration_interval' generations
+    each island sends copies of its 'migrant_count' best genomes to other
+    islands where they replace the worst genomes. 'topology' defines where
+    migrants go: "ring" -- to the next island; "complete" -- to all other
+    islands.
+
+    Workers are prepared using 'Genome.worker_initializer' and genomes are
+    transferred between processes pickled. Parameters and stopping rules are
+    taken from the 'GeneticAlgorithm' passed to 'run', they are applied to
+    the best score of all islands; its instrumentation isn't used. """
+
+    def __init__(self, island_count=None, migration_interval=10,
+                 migrant_count=2, topology="ring"):
+        assert topology in ("ring", "complete"), "Unknown topology"
+        assert migrant_count >= 0, "The number of migrants is negative"
+        self.island_count = island_count or multiprocessing.cpu_count()
+        self.migration_interval = migration_interval
+        self.migrant_count = migrant_count
+        self.topology = topology
+
+    def run(self, algorithm, genome_class, population_size=80,
+            population_class=None):
+
+        population_class = population_class or Population
+
+        island_algorithm = copy.copy(algorithm)
+        island_algorithm.instrumentation = None
+        island_algorithm.generations_without_improvement_limit = sys.maxint
+
+        initializer, arguments = (
+            genome_class.worker_initializer() or (None, ()))
+
+        connections = []
+        processes = []
+
+        try:
+            for _ in xrange(self.island_count):
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_run_island,
+                    args=(worker_connection, initializer, arguments))
+                process.daemon = True
+                process.start()
+                connections.append(connection)
+                processes.append(process)
+
+            # Genome classes may be created dynamically, so a class is sent to
+            # workers as an instance of it
+            prototype = genome_class()
+
+            for connection in connections:
+                connection.send((
+                    prototype, population_class, population_size,
+                    island_algorithm, self.migrant_count,
+                    random.getrandbits(32)))
+
+            return self._evolve(algorithm, connections)
+
+        finally:
+            for connection in connections:
+                connection.close()
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+
+    def _evolve(self, algorithm, connections):
+
+        generation_count = 0
+        mutation_rate = algorithm.mutation_rate
+        immigrants = [[] for _ in connections]
+        best_scores = []
+
+        while generation_count < algorithm.generation_limit:
+
+            generation_limit = min(
+                self.migration_interval,
+                algorithm.generation_limit - generation_count)
+
+            for connection, island_immigrants in zip(connections, immigrants):
+                connection.send((
+                    "evolve",
+                    (generation_limit, mutation_rate, island_immigrants)))
+
+            island_best_scores, emigrants = zip(
+                *[connection.recv() for connection in connections])
+
+            generation_count += generation_limit
+            mutation_rate *= (
+                (1 - algorithm.mutation_decrease_rate) ** generation_limit)
+
+            best_score = max(island_best_scores)
+            logger.info(
+                "Generation %d. Best: %.2f. Islands: %s",
+                generation_count, best_score,
+                ", ".join("%.2f" % score for score in island_best_scores))
+
+            immigrants = self._migrate(emigrants)
+
+            # The same rule as in 'GeneticAlgorithm.run': compare the best
+            # score with the one which was reached the specified number of
+            # generations ago
+            best_scores.append((generation_count, best_score))
+            previous_scores = [
+                score for generation, score in best_scores
+                if generation <= generation_count -
+                    algorithm.generations_without_improvement_limit]
+            if previous_scores and (
+                    best_score - previous_scores[-1] <
+                    algorithm.score_improvement_threshold):
+                break
+
+        for connection in connections:
+            connection.send(("stop", None))
+
+        return max(
+            (connection.recv() for connection in connections),
+            key=_genome_score)
+
+    def _migrate(self, emigrants):
+        """ Returns lists of immigrants of islands """
+
+        island_count = len(emigrants)
+
+        if island_count == 1:
+            return [[]]
+
+        if self.topology == "ring":
+            return [
+                emigrants[(index - 1) % island_count]
+                for index in xrange(island_count)]
+
+        return [
+            [genome
+             for source_index, genomes in enumerate(emigrants)
+             if source_index != index
+             for genome in genomes]
+            for index in xrange(island_count)]
+
 
 def _prepare_logging():
     logger.setLevel(logging.INFO)
@@ -0,0 +1,204 @@
+from collections import OrderedDict
+import hashlib
+import os
+import os.path
+import tempfile
+import weakref
+
+import numpy
+
+from spectrogram import Spectrogram, complex_stft
+
+
+def weight_by_frequency(frequencies):
+    """ To calculate weights this function uses a technique called
+    "A-weighting" """
+    frequencies = numpy.asarray(frequencies, dtype=numpy.float64)
+    return (12200 ** 2) * (frequencies ** 4) / (
+        (frequencies ** 2 + 20.6 ** 2) *
+        numpy.sqrt(frequencies ** 2 + 107.7 ** 2) *
+        numpy.sqrt(frequencies ** 2 + 737.9 ** 2) *
+        (frequencies ** 2 + 12200 ** 2)
+    )
+
+
+def find_spectral_peaks(magnitudes, weights, count, minimal_bin=1,
+                        maximal_bin=None):
+    """ Returns positions of the 'count' strongest peaks of a spectrogram and
+    their energies. The energy of a frequency bin is a weighted sum of its
+    squared magnitudes over all frames. Peaks are local maxima of the energy
+    between 'minimal_bin' and 'maximal_bin'; their positions are fractional
+    bin indices refined by the parabolic interpolation. Peaks are ordered by
+    energy, the strongest one is the first. """
+
+    energies = numpy.sum(numpy.square(magnitudes), axis=0) * weights
+
+    minimal_bin = max(minimal_bin, 1)
+    maximal_bin = min(
+        len(energies) - 2 if maximal_bin is None else maximal_bin,
+        len(energies) - 2)
+
+    centers = energies[minimal_bin:maximal_bin + 1]
+    peaks = minimal_bin + numpy.flatnonzero(
+        (centers > energies[minimal_bin - 1:maximal_bin]) &
+        (centers >= energies[minimal_bin + 1:maximal_bin + 2]))
+    peaks = peaks[numpy.argsort(-energies[peaks], kind="mergesort")][:count]
+
+    tiny = numpy.finfo(numpy.float64).tiny
+    left, center, right = (
+        numpy.log(energies[peaks + offset] + tiny) for offset in (-1, 0, 1))
+    curvatures = left - 2 * center + right
+    offsets = numpy.where(
+        curvatures < 0,
+        0.5 * (left - right) / numpy.where(curvatures < 0, curvatures, -1),
+        0)
+
+    return peaks + numpy.clip(offsets, -0.5, 0.5), energies[peaks]
+
+
+_content_hashes = weakref.WeakKeyDictionary()
+
+
+def get_content_hash(pcm_audio):
+    """ Returns a hash of the sampling rate and samples of 'pcm_audio'. The
+    hash is computed once per object and samples object, so samples must not
+    be modified in place after hashing. """
+
+    samples_id, content_hash = _content_hashes.get(pcm_audio, (None, None))
+
+    if samples_id != id(pcm_audio.samples):
+        samples = numpy.ascontiguousarray(pcm_audio.samples)
+        content_hash = hashlib.sha1()
+        content_hash.update(
+            "%d:%s:%s:" % (pcm_audio.sampling_rate, samples.dtype.str,
+                           samples.shape))
+        content_hash.update(samples.data)
+        content_hash = content_hash.hexdigest()
+        _content_hashes[pcm_audio] = id(pcm_audio.samples), content_hash
+
+    return content_hash
+
+
+class AnalysisCache(object):
+    """ Caches results of the analysis of sounds: spectrograms, complex
+    spectra and values derived from them. Results are keyed by a hash of the
+    analyzed samples and analysis parameters, so they are shared between all
+    PcmAudio objects with the same content.
+
+    Results are kept in memory, at most 'capacity' of them which take at
+    most 'maximal_size' bytes in total, and the least recently used ones are
+    discarded first. The most recently used result is kept even if it's
+    larger than 'maximal_size'. If 'directory' is specified then results
+    which are requested as persistent are also stored there and are reused
+    by subsequent runs. Cached arrays are read-only. """
+
+    def __init__(self, directory=None, capacity=32, maximal_size=2 ** 28):
+        self.directory = directory
+        self.capacity = capacity
+        self.maximal_size = maximal_size
+        self.hit_count = 0
+        self.miss_count = 0
+        self._entries = OrderedDict()
+        # The total size of cached arrays in bytes
+        self._size = 0
+
+    def get_spectrogram(self, pcm_audio, persistent=False, frame_size=4096,
+                        overlapping_size=2048, fft_length=4096):
+        magnitudes = self._get(
+            ("spectrogram", get_content_hash(pcm_audio), frame_size,
+             overlapping_size, fft_length),
+            lambda: Spectrogram(
+                pcm_audio.samples, frame_size, overlapping_size,
+                fft_length).magnitudes,
+            persistent)
+        return Spectrogram.from_magnitudes(magnitudes, fft_length)
+
+    def get_complex_stft(self, pcm_audio, persistent=False, frame_size=4096,
+                         overlapping_size=2048, fft_length=4096):
+        return self._get(
+            ("complex_stft", get_content_hash(pcm_audio), frame_size,
+             overlapping_size, fft_length),
+            lambda: complex_stft(
+                pcm_audio.samples, frame_size, overlapping_size, fft_length),
+            persistent)
+
+    def get_maximal_frequency_index(
+            self, pcm_audio, minimal_significant_amplitude, persistent=False):
+        """ Returns an index of the highest frequency bin of the spectrogram
+        which magnitude reaches 'minimal_significant_amplitude' """
+
+        def compute():
+            magnitudes = self.get_spectrogram(pcm_audio, persistent).magnitudes
+            return numpy.flatnonzero(
+                magnitudes.max(axis=0) >= minimal_significant_amplitude).max()
+
+        return int(self._get(
+            ("maximal_frequency_index", get_content_hash(pcm_audio),
+             minimal_significant_amplitude),
+            compute, persistent))
+
+    def get_frequency_weights(self, sampling_rate, fft_length=4096):
+        return self._get(
+            ("frequency_weights", sampling_rate, fft_length),
+            lambda: weight_by_frequency(
+                numpy.linspace(0, 0.5, fft_length / 2 + 1) * sampling_rate))
+
+    def get_sample_times(self, pcm_audio):
+        sample_count = len(pcm_audio.samples)
+        return self._get(
+            ("sample_times", pcm_audio.sampling_rate, sample_count),
+            lambda: numpy.linspace(0, pcm_audio.duration, sample_count))
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def _get(self, key, compute, persistent=False):
+
+        key = hashlib.sha1(repr(key)).hexdigest()
+
+        if key in self._entries:
+            self.hit_count += 1
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+        filename = None
+        if persistent and self.directory:
+            filename = os.path.join(self.directory, key + ".npy")
+
+        if filename and os.path.exists(filename):
+            self.hit_count += 1
+            value = numpy.load(filename)
+        else:
+            self.miss_count += 1
+            value = numpy.asarray(compute())
+            if filename:
+                self._save(filename, value)
+
+        value.flags.writeable = False
+
+        self._entries[key] = value
+        self._size += value.nbytes
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.capacity or
+                self._size > self.maximal_size):
+            self._size -= self._entries.popitem(last=False)[1].nbytes
+
+        return value
+
+    def _save(self, filename, value):
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write to a temporary file first, so concurrent runs never see a
+        # partially written file
+        descriptor, temporary_filename = tempfile.mkstemp(
+            suffix=".tmp", dir=self.directory)
+        with os.fdopen(descriptor, "wb") as output:
+            numpy.save(output, value)
+        os.rename(temporary_filename, filename)
+
+
+default_analysis_cache = AnalysisCache()
@@ -0,0 +1,112 @@
+import atexit
+import logging
+import Queue
+import threading
+
+
+class ArtifactWriter(object):
+    """ Writes intermediate results of the resynthesis: debug wave files and
+    spectrogram images.
+
+    'mode' defines how artifacts are written: "off" -- they aren't written;
+    "sync" -- immediately by the calling thread; "async" -- by a background
+    thread. In the "async" mode at most 'queue_size' artifacts wait to be
+    written and further submissions block, so pending artifacts don't
+    accumulate in memory. Pending artifacts are written by 'flush', 'close'
+    and at exit. An error of a background write is logged and raised by the
+    next call of 'submit', 'flush' or 'close'.
+
+    'kinds' are kinds of artifacts to write, all of 'ArtifactWriter.kinds' by
+    default. """
+
+    kinds = ("debug_wave", "spectrogram")
+
+    def __init__(self, mode="sync", kinds=None, queue_size=4):
+
+        assert mode in ("off", "sync", "async"), "Unknown mode"
+        assert kinds is None or set(kinds) <= set(ArtifactWriter.kinds), \
+            "Unknown artifact kind"
+
+        self.mode = mode
+        self.enabled_kinds = frozenset(
+            ArtifactWriter.kinds if kinds is None else kinds)
+
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._closed = False
+
+        if mode == "async":
+            self._queue = Queue.Queue(queue_size)
+            # The thread is a daemon, so it doesn't prevent the exit; pending
+            # artifacts are written by 'close' which is called at exit
+            self._thread = threading.Thread(
+                target=self._write_queued_artifacts, name="ArtifactWriter")
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.close)
+
+    def is_enabled(self, kind):
+        return self.mode != "off" and kind in self.enabled_kinds
+
+    def submit(self, kind, function, *arguments):
+        """ Writes an artifact of the specified kind, if it's enabled, by
+        calling 'function' with 'arguments'. Arguments must not be modified
+        after the submission. """
+
+        if not self.is_enabled(kind):
+            return
+
+        assert not self._closed, "The writer is closed"
+
+        self._raise_error()
+
+        if self._queue is None:
+            function(*arguments)
+        else:
+            self._queue.put((function, arguments))
+
+    def flush(self):
+        """ Waits until all submitted artifacts are written """
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+
+        if self._closed:
+            return
+
+        self._closed = True
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+        self._raise_error()
+
+    def _write_queued_artifacts(self):
+
+        while True:
+
+            item = self._queue.get()
+
+            try:
+                if item is None:
+                    return
+                function, arguments = item
+                function(*arguments)
+            except Exception as error:
+                logger.exception("Failed to write an artifact")
+                if self._error is None:
+                    self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+
+logger = logging.getLogger("ArtifactWriter")
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+""" Benchmarks of the hot paths of the resynthesis on the bundled sounds.
+Random generators are seeded, so results of different commits are
+comparable. Results are written as JSON. """
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy
+
+from algorithm import GeneticAlgorithm, Instrumentation, Population
+from analysis import AnalysisCache
+from pcm_audio import PcmAudio
+from resynthesis import resynthesize
+from sound import get_sound_factory
+from spectrogram import Spectrogram, spectrum
+
+
+_repository_directory = os.path.dirname(os.path.abspath(__file__))
+
+_default_sounds = [
+    os.path.join(_repository_directory, "sounds", name)
+    for name in ("guitar.wav", "violin.wav", "bell.wav", "flute.wav")]
+
+
+def get_peak_rss():
+    """ Returns the peak resident set size of the process in bytes """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def measure(function, repeat, setup=None, items=1):
+    """ Calls 'function' 'repeat' times and returns statistics of its
+    latency. 'setup' is called before each call and isn't measured, its
+    result is passed to 'function'. 'items' is a number of processed items
+    per call which is used to calculate the throughput. """
+
+    latencies = []
+
+    for _ in xrange(repeat):
+        argument = setup() if setup else None
+        start_time = default_timer()
+        function(argument) if setup else function()
+        latencies.append(default_timer() - start_time)
+
+    latencies = numpy.array(latencies)
+    percentiles = numpy.percentile(latencies, [50, 90, 99])
+
+    return {
+        "calls": repeat,
+        "total_time": latencies.sum(),
+        "throughput": repeat * items / latencies.sum(),
+        "latency": {
+            "min": latencies.min(),
+            "p50": percentiles[0],
+            "p90": percentiles[1],
+            "p99": percentiles[2],
+            "max": latencies.max()
+        },
+        "peak_rss": get_peak_rss()
+    }
+
+
+def benchmark_sound(pcm_audio, arguments):
+
+    results = {}
+
+    samples = numpy.asarray(pcm_audio.samples, dtype=numpy.float64)
+
+    frame = samples[:4096]
+    results["spectrum"] = measure(
+        lambda: spectrum(frame, 4096), arguments.repeat * 100)
+
+    results["spectrogram"] = measure(
+        lambda: Spectrogram(samples), arguments.repeat)
+
+    random.seed(arguments.seed)
+
+    sound_factory = get_sound_factory(
+        pcm_audio, None, arguments.evaluation_mode, arguments.spectral_engine,
+        AnalysisCache())
+
+    sounds = [sound_factory() for _ in xrange(arguments.repeat)]
+
+    results["to_pcm_audio"] = measure(
+        lambda sound: sound.to_pcm_audio(), arguments.repeat,
+        iter(sounds).next)
+
+    results["evaluate"] = measure(
+        lambda sound: sound.evaluate(), arguments.repeat, iter(sounds).next)
+
+    results["evaluate_batch"] = measure(
+        lambda: sound_factory.evaluate_batch(sounds), 1, items=len(sounds))
+
+    def prepare_population():
+        population = Population(sound_factory, arguments.population_size)
+        population.evaluate()
+        return population
+
+    algorithm = GeneticAlgorithm()
+    algorithm.generation_limit = 1
+
+    results["generation"] = measure(
+        algorithm.run, max(arguments.repeat / 10, 3), prepare_population)
+
+    return results
+
+
+def benchmark_resynthesis(pcm_audio, arguments):
+    """ Runs the whole resynthesis and records the best score of each
+    generation against the elapsed time """
+
+    trace = []
+    start_time = default_timer()
+
+    def record_score(record):
+        if record["event"] == "generation":
+            trace.append({
+                "time": default_timer() - start_time,
+                "partial": record["partial"],
+                "generation": record["generation"],
+                "best_score": record["best_score"]
+            })
+
+    # The resynthesis writes intermediate files to the current directory
+    working_directory = os.getcwd()
+    temporary_directory = tempfile.mkdtemp()
+    shutil.copy(
+        os.path.join(_repository_directory, "template.csd"),
+        temporary_directory)
+
+    try:
+        os.chdir(temporary_directory)
+        resynthesize(
+            pcm_audio, None, arguments.evaluation_mode,
+            arguments.spectral_engine, AnalysisCache(),
+            seed=arguments.seed,
+            instrumentation=Instrumentation([record_score]),
+            partial_count=arguments.partials,
+            generation_limit=arguments.generations)
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(temporary_directory)
+
+    return {
+        "total_time": default_timer() - start_time,
+        "final_score": trace[-1]["best_score"] if trace else None,
+        "score_trace": trace,
+        "peak_rss": get_peak_rss()
+    }
+
+
+def get_environment():
+
+    environment = {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor()
+    }
+
+    try:
+        environment["commit"] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=_repository_directory,
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return environment
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "sounds", nargs="*", default=_default_sounds,
+        help=".wav files to benchmark on (default: bundled sounds)")
+    parser.add_argument(
+        "--output", default="benchmark.json",
+        help="output .json file name")
+    parser.add_argument(
+        "--repeat", type=int, default=30,
+        help="number of measured calls of each function")
+    parser.add_argument(
+        "--population-size", type=int, default=80)
+    parser.add_argument(
+        "--evaluation-mode", choices=("synthesis", "residual", "band"),
+        default="synthesis")
+    parser.add_argument(
+        "--spectral-engine", choices=("fft", "analytic"), default="fft")
+    parser.add_argument(
+        "--partials", type=int, default=2,
+        help="number of partials of the full resynthesis")
+    parser.add_argument(
+        "--generations", type=int, default=20,
+        help="generation limit of each partial of the full resynthesis")
+    parser.add_argument(
+        "--skip-resynthesis", action="store_true")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed")
+    arguments = parser.parse_args()
+
+    logging.getLogger("GeneticAlgorithm").setLevel(logging.WARNING)
+
+    results = {
+        "environment": get_environment(),
+        "parameters": vars(arguments),
+        "sounds": {}
+    }
+
+    for filename in arguments.sounds:
+
+        print "Benchmarking '%s'" % filename
+
+        pcm_audio = PcmAudio.from_wave_file(filename)
+
+        sound_results = benchmark_sound(pcm_audio, arguments)
+
+        for name, result in sorted(sound_results.iteritems()):
+            print "  %-16s %10.1f/s  p50 %8.2f ms  p99 %8.2f ms" % (
+                name, result["throughput"], result["latency"]["p50"] * 1000,
+                result["latency"]["p99"] * 1000)
+
+        if not arguments.skip_resynthesis:
+            result = benchmark_resynthesis(pcm_audio, arguments)
+            sound_results["resynthesis"] = result
+            final_score = result["final_score"]
+            print "  %-16s %10.2f s   score %s" % (
+                "resynthesis", result["total_time"],
+                "n/a" if final_score is None else "%.2f" % final_score)
+
+        results["sounds"][os.path.basename(filename)] = sound_results
+
+    results["peak_rss"] = get_peak_rss()
+
+    with open(arguments.output, "w") as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    print "Peak RSS: %.1f MB" % (results["peak_rss"] / 2.0 ** 20)
+    print "Results are written to '%s'" % arguments.output
+
+
+if __name__ == "__main__":
+    main()
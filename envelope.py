@@ -1,9 +1,44 @@
+import bisect
+
 import numpy
 
 
-class Envelope:
+def interpolate(x, xp, fp, out=None):
+    """ The same as 'numpy.interp(x, xp, fp)' but the result can be written
+    into 'out'. Then segments of the piecewise linear function are computed
+    in place, without temporary arrays of the size of 'x', which must be
+    sorted in this case. """
+
+    if out is None:
+        return numpy.interp(x, xp, fp)
+
+    bounds = numpy.searchsorted(x, xp)
+
+    out[:bounds[0]] = fp[0]
+
+    for index in xrange(len(xp) - 1):
+        start, end = bounds[index], bounds[index + 1]
+        if start == end:
+            continue
+        segment = numpy.subtract(x[start:end], xp[index], out=out[start:end])
+        segment *= (fp[index + 1] - fp[index]) / (xp[index + 1] - xp[index])
+        segment += fp[index]
+
+    out[bounds[-1]:] = fp[-1]
+
+    return out
+
+
+class Envelope(object):
+    """ A piecewise linear function of time defined by points. Points are
+    kept as arrays sorted by time, which are rebuilt only after points are
+    added. Added points are copied, so changing them later doesn't change
+    the envelope. """
+
+    class Point(object):
+
+        __slots__ = ("time", "value")
 
-    class Point:
         def __init__(self, time, value):
             self.time = time
             self.value = value
@@ -13,20 +48,48 @@ class Envelope:
                 time=self.time, value=self.value)
 
     def __init__(self):
-        self.__points = list()
+        self.__values_by_time = {}
+        self.__times = None
+        self.__values = None
 
     def add_point(self, new_point):
-        for point in self.__points:
-            if point.time == new_point.time:
-                point.value = new_point.value
-                return
-        self.__points.append(new_point)
+        """ Adds a point or replaces the value of the point with the same
+        time """
+        self.__values_by_time[new_point.time] = new_point.value
+        self.__times = None
+
+    def get_output(self, time_points, out=None):
+        """ Returns values of the envelope at 'time_points' (a number or an
+        array). If 'out' is specified then values are written into it;
+        'time_points' must be sorted in this case. """
+
+        if self.__times is None:
+            self.__update_arrays()
+
+        if out is None and isinstance(time_points, (float, int)):
+            return self.__get_value(time_points)
+
+        return interpolate(time_points, self.__times, self.__values, out)
+
+    def __update_arrays(self):
+        times = sorted(self.__values_by_time)
+        self.__time_list = times
+        self.__value_list = [self.__values_by_time[time] for time in times]
+        self.__times = numpy.array(times, dtype=numpy.float64)
+        self.__values = numpy.array(self.__value_list, dtype=numpy.float64)
 
-    def get_output(self, time_points):
+    def __get_value(self, time):
+        """ The same as 'numpy.interp' for a single time, but without the
+        overhead of array conversions """
 
-        self.__points.sort(key=lambda point: point.time)
+        times, values = self.__time_list, self.__value_list
 
-        x = numpy.fromiter((point.time for point in self.__points), numpy.float)
-        y = numpy.fromiter((point.value for point in self.__points), numpy.float)
+        index = bisect.bisect_right(times, time)
+        if index == 0:
+            return values[0]
+        if index == len(times):
+            return values[-1]
 
-        return numpy.interp(time_points, x, y)
+        slope = (values[index] - values[index - 1]) / (
+            times[index] - times[index - 1])
+        return slope * (time - times[index - 1]) + values[index - 1]
@@ -1,21 +1,223 @@
 #!/usr/bin/env python
 
-import sys
+import argparse
 
+from algorithm import (
+    Instrumentation, IslandModel, JsonLinesSink, ProcessPoolEvaluator,
+    SerialEvaluator, ThreadPoolEvaluator)
+from analysis import AnalysisCache
+from artifacts import ArtifactWriter
 from pcm_audio import PcmAudio
-from resynthesis import resynthesize
+from resynthesis import resynthesize, resynthesize_segments
+
+
+def _parse_fidelity_schedule(text):
+    """ Parses a schedule like "0.25:0.5,0.5:0.5" """
+    try:
+        schedule = [
+            tuple(float(value) for value in stage.split(":"))
+            for stage in text.split(",")]
+    except ValueError:
+        schedule = None
+    if not schedule or any(len(stage) != 2 for stage in schedule):
+        raise argparse.ArgumentTypeError("invalid schedule: %r" % text)
+    return schedule
+
+
+def _parse_non_negative_integer(text):
+    try:
+        value = int(text)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+            "invalid non-negative integer: %r" % text)
+    return value
+
+
+def _parse_artifact_kinds(text):
+    """ Parses a list like "debug_wave,spectrogram" """
+    kinds = [kind for kind in text.split(",") if kind]
+    if not set(kinds) <= set(ArtifactWriter.kinds):
+        raise argparse.ArgumentTypeError("invalid artifact kinds: %r" % text)
+    return kinds
+
+
+_evaluator_by_name = {
+    "serial": lambda workers: SerialEvaluator(),
+    "threads": ThreadPoolEvaluator,
+    "processes": ProcessPoolEvaluator
+}
 
 
 def main():
 
-    if len(sys.argv) < 3:
-        sys.exit("Usage: python main.py <input .wav file name> <output .wav file name>")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_filename", help="input .wav file name")
+    parser.add_argument("output_filename", help="output .wav file name")
+    parser.add_argument(
+        "--evaluator", choices=sorted(_evaluator_by_name), default="serial",
+        help="how to evaluate genomes of each generation")
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of evaluation workers or segment processes (default: "
+             "number of CPUs)")
+    parser.add_argument(
+        "--evaluation-mode", choices=("synthesis", "residual", "band"),
+        default="synthesis", help="how to compute spectra of partials")
+    parser.add_argument(
+        "--spectral-engine", choices=("fft", "analytic"), default="fft",
+        help="how to compute spectra of partials in the residual and band "
+             "modes; \"analytic\" requires the band mode")
+    parser.add_argument(
+        "--cache-dir", default=None,
+        help="directory to keep analysis results of input files between runs")
+    parser.add_argument(
+        "--score-cache-size", type=int, default=0,
+        help="number of scores to memoize per partial (default: disabled; "
+             "few scores are reused, so the cache is rarely worth it)")
+    parser.add_argument(
+        "--score-cache-resolution", type=float, default=1e-3,
+        help="resolution of genome parameters for score memoization, "
+             "relative to a frequency bin and a frame")
+    parser.add_argument(
+        "--array-population", action="store_true",
+        help="store populations as gene matrices with vectorized operators")
+    parser.add_argument(
+        "--initialization", choices=("random", "peaks"), default="random",
+        help="how to create initial sounds of each partial")
+    parser.add_argument(
+        "--optimizer",
+        choices=("genetic", "cma-es", "differential-evolution"),
+        default="genetic", help="how to search parameters of each partial")
+    parser.add_argument(
+        "--seed", type=int, default=None, help="random seed")
+    parser.add_argument(
+        "--fidelity-schedule", type=_parse_fidelity_schedule, default=None,
+        help="evaluate genomes with successive halving: comma separated "
+             "FIDELITY:PROMOTION_RATE stages, e.g. 0.25:0.5")
+    parser.add_argument(
+        "--early-abort", action="store_true",
+        help="stop evaluation of sounds which can't survive selection")
+    parser.add_argument(
+        "--refinement-interval", type=int, default=0,
+        help="number of generations between local refinements of the best "
+             "sounds (default: no refinement; requires the residual or band "
+             "evaluation mode)")
+    parser.add_argument(
+        "--retuning-steps", type=int, default=0,
+        help="number of refinement steps of each previous partial after a "
+             "new one is found (default: no re-tuning; requires the residual "
+             "or band evaluation mode)")
+    parser.add_argument(
+        "--islands", type=int, default=0,
+        help="number of populations evolving in parallel processes "
+             "(default: a single population)")
+    parser.add_argument(
+        "--migration-interval", type=int, default=10,
+        help="number of generations between migrations between islands")
+    parser.add_argument(
+        "--migrants", type=_parse_non_negative_integer, default=2,
+        help="number of genomes each island sends on migration (0 means "
+             "islands evolve independently)")
+    parser.add_argument(
+        "--topology", choices=("ring", "complete"), default="ring",
+        help="where migrants of each island go")
+    parser.add_argument(
+        "--artifacts-mode", choices=("off", "sync", "async"), default="sync",
+        help="how to write debug wave files and spectrogram images: not at "
+             "all, immediately or by a background thread")
+    parser.add_argument(
+        "--artifacts", type=_parse_artifact_kinds,
+        default=ArtifactWriter.kinds,
+        help="comma separated kinds of artifacts to write (default: %s)" %
+             ",".join(ArtifactWriter.kinds))
+    parser.add_argument(
+        "--artifact-queue-size", type=int, default=4,
+        help="number of artifacts which can wait for the background thread")
+    parser.add_argument(
+        "--segment-duration", type=float, default=0,
+        help="resynthesize the input by overlapping segments of this "
+             "duration in seconds in parallel processes (default: the whole "
+             "input at once)")
+    parser.add_argument(
+        "--segment-overlap", type=float, default=1.0,
+        help="duration of crossfades between segments in seconds")
+    parser.add_argument(
+        "--model-dir", default=None,
+        help="directory to export partials of each segment to")
+    parser.add_argument(
+        "--metrics", default=None,
+        help="file to append per-generation metrics to, as JSON lines")
+    arguments = parser.parse_args()
+
+    if (arguments.spectral_engine == "analytic" and
+            arguments.evaluation_mode != "band"):
+        parser.error("the analytic spectral engine requires the band mode")
+
+    resynthesis_arguments = dict(
+        evaluation_mode=arguments.evaluation_mode,
+        spectral_engine=arguments.spectral_engine,
+        analysis_cache=AnalysisCache(arguments.cache_dir),
+        score_cache_capacity=arguments.score_cache_size,
+        score_cache_resolution=arguments.score_cache_resolution,
+        array_population=arguments.array_population,
+        fidelity_schedule=arguments.fidelity_schedule,
+        early_abort=arguments.early_abort,
+        initialization=arguments.initialization,
+        optimizer=arguments.optimizer,
+        refinement_interval=arguments.refinement_interval,
+        retuning_step_count=arguments.retuning_steps)
+
+    if arguments.islands and (
+            arguments.evaluator != "serial" or arguments.fidelity_schedule or
+            arguments.metrics):
+        parser.error(
+            "islands evaluate genomes serially in their own processes, so "
+            "other evaluators, fidelity schedules and metrics aren't "
+            "supported")
+
+    if arguments.segment_duration:
+        if (arguments.evaluator != "serial" or arguments.islands or
+                arguments.metrics):
+            parser.error(
+                "segments are resynthesized by parallel processes, so other "
+                "evaluators, islands and metrics aren't supported")
+        resynthesize_segments(
+            arguments.input_filename, arguments.output_filename,
+            arguments.segment_duration, arguments.segment_overlap,
+            arguments.workers, arguments.model_dir, arguments.seed,
+            **resynthesis_arguments)
+        return
+
+    evaluator = _evaluator_by_name[arguments.evaluator](arguments.workers)
+
+    island_model = (
+        IslandModel(
+            arguments.islands, arguments.migration_interval,
+            arguments.migrants, arguments.topology)
+        if arguments.islands else None)
+
+    instrumentation = (
+        Instrumentation([JsonLinesSink(arguments.metrics)])
+        if arguments.metrics else None)
 
-    _, input_filename, output_filename = sys.argv
+    artifact_writer = ArtifactWriter(
+        arguments.artifacts_mode, arguments.artifacts,
+        arguments.artifact_queue_size)
 
-    pcm_audio = PcmAudio.from_wave_file(input_filename)
-    synthesized_pcm_audio = resynthesize(pcm_audio)
-    synthesized_pcm_audio.to_wave_file(output_filename)
+    try:
+        pcm_audio = PcmAudio.from_wave_file(arguments.input_filename)
+        synthesized_pcm_audio = resynthesize(
+            pcm_audio, evaluator, seed=arguments.seed,
+            instrumentation=instrumentation, island_model=island_model,
+            artifact_writer=artifact_writer, **resynthesis_arguments)
+        synthesized_pcm_audio.to_wave_file(arguments.output_filename)
+    finally:
+        artifact_writer.close()
+        evaluator.close()
+        if instrumentation:
+            instrumentation.close()
 
 
 if __name__ == "__main__":
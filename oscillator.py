@@ -1,12 +1,20 @@
 import numpy
 
+from envelope import interpolate
+from workspace import get_workspace
+
 
 class Oscillator:
 
-    def __init__(self, frequency=440, phase=0, wave="sine"):
+    def __init__(self, frequency=440, phase=0, wave="sine",
+                 sampling_rate=None):
+        """ 'phase' is in radians. If 'sampling_rate' is specified then the
+        sawtooth wave is band-limited: it consists of harmonics below the
+        Nyquist frequency. """
 
         self.frequency = frequency
         self.phase = phase
+        self.sampling_rate = sampling_rate
 
         output_method_by_wave = {
             "sine": self._get_sine_output,
@@ -15,12 +23,126 @@ class Oscillator:
 
         self.get_output = output_method_by_wave[wave]
 
-    def _get_sine_output(self, time_points):
-        arguments = (2 * numpy.pi * self.frequency) * time_points
+    def _get_sine_output(self, time_points, out=None):
+        arguments = numpy.multiply(
+            2 * numpy.pi * self.frequency, time_points, out=out)
         arguments += self.phase
         return numpy.sin(arguments, out=arguments)
 
-    def _get_sawtooth_output(self, time_points):
-        arguments = self.frequency * time_points
-        arguments += self.phase
-        return numpy.modf(arguments)[0] * 2 - 1
+    def _get_sawtooth_output(self, time_points, out=None):
+
+        if self.sampling_rate:
+            # The Fourier series of the sawtooth wave:
+            # -2 / pi * sum(sin(k * x) / k)
+            harmonic_count = max(
+                int(self.sampling_rate / 2 / abs(self.frequency)), 1)
+            harmonics = numpy.arange(1, harmonic_count + 1)
+            bank = OscillatorBank(
+                self.frequency * harmonics, self.phase * harmonics,
+                -2 / numpy.pi / harmonics)
+            return bank.render_sum(time_points, out)
+
+        # Phases are in periods
+        arguments = numpy.multiply(self.frequency, time_points, out=out)
+        arguments += self.phase / (2 * numpy.pi)
+        numpy.mod(arguments, 1, out=arguments)
+        arguments *= 2
+        arguments -= 1
+        return arguments
+
+
+class OscillatorBank(object):
+    """ Renders several sine oscillators at once. Outputs of oscillators are
+    multiplied by 'amplitudes' (numbers) and optionally by piecewise linear
+    envelopes given as matrices of point times and values, a row per
+    oscillator. Points of each envelope must be sorted by time.
+
+    'mode' defines how sines are computed: "exact" -- by 'numpy.sin';
+    "table" -- by the lookup of the nearest value in a table of 'table_size'
+    sine values, which is several times faster. The error of the table is at
+    most 'pi / table_size', so larger tables are more accurate; the size must
+    be a power of two. """
+
+    def __init__(self, frequencies, phases, amplitudes=None,
+                 envelope_times=None, envelope_values=None, mode="exact",
+                 table_size=65536):
+
+        assert mode in ("exact", "table"), "Unknown mode"
+        assert table_size & (table_size - 1) == 0, \
+            "The table size isn't a power of two"
+
+        self.frequencies = numpy.asarray(frequencies, dtype=numpy.float64)
+        self.phases = numpy.asarray(phases, dtype=numpy.float64)
+        self.amplitudes = amplitudes
+        self.envelope_times = envelope_times
+        self.envelope_values = envelope_values
+        self.mode = mode
+
+        if mode == "table":
+            self._table = numpy.sin(
+                numpy.arange(table_size) * (2 * numpy.pi / table_size))
+
+    def render(self, time_points, out=None):
+        """ Returns a matrix which rows are outputs of the oscillators at
+        'time_points'. The result is written into 'out' if it's specified;
+        'time_points' must be sorted in this case. """
+
+        samples = numpy.multiply.outer(
+            2 * numpy.pi * self.frequencies, time_points, out=out)
+        samples += self.phases[:, numpy.newaxis]
+
+        if self.mode == "exact":
+            numpy.sin(samples, out=samples)
+        else:
+            self._lookup_sines(samples)
+
+        if self.amplitudes is not None:
+            samples *= numpy.asarray(self.amplitudes)[:, numpy.newaxis]
+
+        if self.envelope_times is not None:
+            envelope = get_workspace().get("envelope", samples.shape[-1:])
+            for row, point_times, point_values in zip(
+                    samples, self.envelope_times, self.envelope_values):
+                row *= interpolate(
+                    time_points, point_times, point_values,
+                    envelope if out is not None else None)
+
+        return samples
+
+    def render_sum(self, time_points, out=None, block_size=16384):
+        """ Returns the sum of outputs of the oscillators at 'time_points'
+        (sorted). Samples are rendered in blocks, so the memory doesn't
+        depend on the number of oscillators times the number of samples. """
+
+        time_points = numpy.asarray(time_points, dtype=numpy.float64)
+
+        if out is None:
+            out = numpy.empty(len(time_points))
+
+        buffer = get_workspace().get(
+            "oscillator_bank", (len(self.frequencies), block_size))
+
+        for start in xrange(0, len(time_points), block_size):
+            end = min(start + block_size, len(time_points))
+            block = self.render(
+                time_points[start:end], buffer[:, :end - start])
+            numpy.sum(block, axis=0, out=out[start:end])
+
+        return out
+
+    def _lookup_sines(self, arguments):
+        """ Replaces arguments (in radians) by their sines using the table """
+
+        table_size = len(self._table)
+
+        positions = arguments
+        positions *= table_size / (2 * numpy.pi)
+        numpy.rint(positions, out=positions)
+
+        indices = get_workspace().get(
+            "table_indices", positions.shape, numpy.intp)
+        numpy.copyto(indices, positions, casting="unsafe")
+        # The table size is a power of two, so this is a modulo
+        numpy.bitwise_and(indices, table_size - 1, out=indices)
+
+        numpy.take(self._table, indices, out=arguments, mode="wrap")
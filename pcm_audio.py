@@ -1,7 +1,94 @@
-import contextlib
+import os
 import struct
 import wave
 
+import numpy
+
+
+# Samples of all formats are converted to the scale of 16-bit samples
+_scale_by_format = {
+    (1, 1): 2.0 ** 8,
+    (1, 2): 1.0,
+    (1, 3): 2.0 ** -8,
+    (1, 4): 2.0 ** -16,
+    (3, 4): 2.0 ** 15,
+    (3, 8): 2.0 ** 15
+}
+
+_pcm_format = 1
+_float_format = 3
+_extensible_format = 0xFFFE
+
+
+def _read_wave_header(wave_file):
+    """ Parses chunks of a RIFF wave file up to the data chunk. Returns the
+    format code, the number of channels, the sampling rate, the size of a
+    sample in bytes, the offset and the size of sample data. """
+
+    riff_id, _, wave_id = struct.unpack("<4sI4s", wave_file.read(12))
+    assert riff_id == "RIFF" and wave_id == "WAVE", "Not a wave file"
+
+    file_size = os.fstat(wave_file.fileno()).st_size
+    wave_format = None
+
+    while True:
+
+        header = wave_file.read(8)
+        assert len(header) == 8, "The wave file has no data chunk"
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+
+        if chunk_id == "fmt ":
+            fields = wave_file.read(chunk_size + chunk_size % 2)
+            format_code, channel_count, sampling_rate, _, block_size, _ = \
+                struct.unpack("<HHIIHH", fields[:16])
+            if format_code == _extensible_format:
+                # The format is the first field of the subformat GUID
+                format_code, = struct.unpack("<H", fields[24:26])
+            wave_format = (
+                format_code, channel_count, sampling_rate,
+                block_size / channel_count)
+
+        elif chunk_id == "data":
+            assert wave_format, "The data chunk precedes the format chunk"
+            data_offset = wave_file.tell()
+            # Streaming writers can leave the size of the data chunk unset
+            return wave_format + (
+                data_offset, min(chunk_size, file_size - data_offset))
+
+        else:
+            wave_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def read_wave_file_info(filename):
+    """ Returns the sampling rate and the number of frames of a wave file
+    without reading its samples """
+
+    with open(filename, "rb") as wave_file:
+        _, channel_count, sampling_rate, sample_size, _, data_size = \
+            _read_wave_header(wave_file)
+
+    return sampling_rate, data_size / (channel_count * sample_size)
+
+
+def _decode_frames(data, format_code, channel_count, sample_size):
+    """ Returns a matrix (frames, channels) of samples of raw frames given
+    as a matrix of bytes (frames, bytes) """
+
+    if format_code == _float_format:
+        return data.view("<f%d" % sample_size)
+
+    if sample_size == 1:
+        return data.astype(numpy.int16) - 128
+
+    if sample_size == 3:
+        # Bytes are placed to the most significant bytes of 32-bit integers,
+        # so the arithmetic shift extends the sign
+        padded = numpy.zeros((len(data), channel_count, 4), numpy.uint8)
+        padded[..., 1:] = data.reshape(len(data), channel_count, 3)
+        return padded.view("<i4")[..., 0] >> 8
+
+    return data.view("<i%d" % sample_size)
+
 
 class PcmAudio:
 
@@ -11,40 +98,105 @@ class PcmAudio:
         self.samples = samples
 
     @staticmethod
-    def from_wave_file(filename):
+    def from_wave_file(filename, memory_map=True, block_size=2 ** 18,
+                       first_frame=0, frame_count=None):
+        """ Loads a wave file with 8, 16, 24 or 32-bit integer or 32 or
+        64-bit float samples. Samples are returned as an array in the scale
+        of 16-bit samples; channels of multichannel files are averaged.
+
+        If 'memory_map' is true then sample data is mapped from the file
+        instead of being read. Samples of 16-bit mono files are the mapped
+        data itself (a read-only array), the other formats are converted
+        by blocks of 'block_size' frames, so temporary arrays don't depend on
+        the length of a file.
+
+        Only 'frame_count' frames (all by default) starting from
+        'first_frame' are loaded. """
+
+        with open(filename, "rb") as wave_file:
+
+            (format_code, channel_count, sampling_rate, sample_size,
+             data_offset, data_size) = _read_wave_header(wave_file)
+
+            assert (format_code, sample_size) in _scale_by_format, \
+                "Unsupported sample format"
+
+            frame_size = channel_count * sample_size
+            first_frame = min(first_frame, data_size / frame_size)
+            available_frame_count = data_size / frame_size - first_frame
+            frame_count = (
+                available_frame_count if frame_count is None else
+                min(frame_count, available_frame_count))
+            data_offset += first_frame * frame_size
+
+            if not frame_count:
+                data = numpy.zeros(0, numpy.uint8)
+            elif memory_map:
+                data = numpy.memmap(
+                    wave_file, numpy.uint8, "r", data_offset,
+                    frame_count * frame_size)
+            else:
+                wave_file.seek(data_offset)
+                data = numpy.fromfile(
+                    wave_file, numpy.uint8, frame_count * frame_size)
+
+        data = data.view(type=numpy.ndarray).reshape(frame_count, frame_size)
+
+        if (format_code, sample_size, channel_count) == (_pcm_format, 2, 1):
+            return PcmAudio(sampling_rate, data.view("<i2")[:, 0])
+
+        scale = _scale_by_format[format_code, sample_size]
+        samples = numpy.empty(frame_count)
+
+        for start in xrange(0, frame_count, block_size):
+            end = min(start + block_size, frame_count)
+            frames = _decode_frames(
+                data[start:end], format_code, channel_count, sample_size)
+            numpy.mean(
+                frames, axis=-1, dtype=numpy.float64, out=samples[start:end])
+
+        samples *= scale
 
-        with contextlib.closing(wave.open(filename, "rb")) as wave_file:
+        return PcmAudio(sampling_rate, samples)
 
-            assert wave_file.getnchannels() == 1, "Only mono wave files are supported"
+    def to_wave_file(self, filename, block_size=2 ** 16):
 
-            bytes_per_sample = wave_file.getsampwidth()
-            sampling_rate = wave_file.getframerate()
-            frames_count = wave_file.getnframes()
+        samples = numpy.asarray(self.samples)
 
-            sample_data = wave_file.readframes(frames_count)
+        with WaveWriter(filename, self.sampling_rate) as writer:
+            for start in xrange(0, len(samples), block_size):
+                writer.write(samples[start:start + block_size])
 
-        sample_count = len(sample_data) / bytes_per_sample
+    @property
+    def duration(self):
+        return len(self.samples) / float(self.sampling_rate)
 
-        if bytes_per_sample == 1:
-            sample_format = "B"
-        elif bytes_per_sample == 2:
-            sample_format = "h"
-        elif bytes_per_sample == 4:
-            sample_format = "i"
 
-        samples = struct.unpack("<%d%s" % (sample_count, sample_format), sample_data)
+class WaveWriter(object):
+    """ Writes a 16-bit mono wave file by blocks of samples, so a long sound
+    doesn't have to be in memory at once. Samples are rounded and clipped to
+    the 16-bit range. """
 
-        return PcmAudio(sampling_rate, samples)
+    def __init__(self, filename, sampling_rate):
 
-    def to_wave_file(self, filename):
+        self._wave_file = wave.open(filename, "wb")
+        self._wave_file.setnchannels(1)
+        self._wave_file.setframerate(sampling_rate)
+        self._wave_file.setsampwidth(2)
 
-        with contextlib.closing(wave.open(filename, "wb")) as wave_file:
+    def write(self, samples):
 
-            wave_file.setnchannels(1)
-            wave_file.setframerate(self.sampling_rate)
-            wave_file.setsampwidth(2)
-            wave_file.writeframes(struct.pack("<%dh" % len(self.samples), *self.samples))
+        samples = numpy.rint(samples)
+        numpy.clip(samples, -2 ** 15, 2 ** 15 - 1, out=samples)
 
-    @property
-    def duration(self):
-        return len(self.samples) / float(self.sampling_rate)
+        # The header is patched with the final size when the file is closed
+        self._wave_file.writeframesraw(samples.astype("<i2").tostring())
+
+    def close(self):
+        self._wave_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
@@ -1,34 +1,136 @@
+from collections import deque
+import json
+import multiprocessing
 import os.path
+import random
 from StringIO import StringIO
 
 import numpy
 
-from algorithm import GeneticAlgorithm, Population
-from pcm_audio import PcmAudio
-from sound import get_sound_factory
-from spectrogram import Spectrogram
-
-
-def resynthesize(reference_pcm_audio):
-
-    Spectrogram(reference_pcm_audio.samples).to_tga_file(
-        "reference_spectrogram.tga")
-
-    algorithm = GeneticAlgorithm()
+from algorithm import (
+    ArrayPopulation, CmaEvolutionStrategy, DifferentialEvolution,
+    GeneticAlgorithm, MultiFidelityEvaluator, Population, ScoreCache,
+    SerialEvaluator)
+from analysis import default_analysis_cache
+from artifacts import ArtifactWriter
+from pcm_audio import PcmAudio, WaveWriter, read_wave_file_info
+from sound import get_sound_factory, is_significant, render_partials
+
+
+_algorithm_by_optimizer = {
+    "genetic": GeneticAlgorithm,
+    "cma-es": CmaEvolutionStrategy,
+    "differential-evolution": DifferentialEvolution
+}
+
+
+def resynthesize(
+        reference_pcm_audio, evaluator=None, evaluation_mode="synthesis",
+        spectral_engine="fft", analysis_cache=None, score_cache_capacity=0,
+        score_cache_resolution=1e-3, array_population=False, seed=None,
+        instrumentation=None, partial_count=20, generation_limit=None,
+        fidelity_schedule=None, early_abort=False, initialization="random",
+        island_model=None, optimizer="genetic", refinement_interval=0,
+        retuning_step_count=0, artifact_writer=None, base_filename="base.wav",
+        csound_filename="out.csd", model_filename=None):
+    """ Approximates the reference sound with a sum of partials which are
+    found one by one. If 'retuning_step_count' is positive then after each
+    new partial all previous partials are re-tuned one at a time against the
+    sum of the other partials (block coordinate descent) using this number
+    of 'Sound.refine' steps. Re-tuning requires the residual or band
+    evaluation mode.
+
+    Scores are memoized only if 'score_cache_capacity' is positive (see
+    'ScoreCache'). The cache is opt-in: genetic operators rarely produce
+    genomes which are closer than 'score_cache_resolution', so few scores
+    are reused.
+
+    Spectrogram images and debug wave files of intermediate sums are written
+    by 'artifact_writer', which writes them synchronously by default. All
+    of them are written when the function returns.
+
+    If a file 'base_filename' exists then partials are added to its sound.
+    The found partials are written as a Csound file 'csound_filename' and,
+    optionally, as a model file 'model_filename' (see 'write_model_file').
+    None disables any of these files. """
+
+    analysis_cache = analysis_cache or default_analysis_cache
+    artifact_writer = artifact_writer or ArtifactWriter()
+
+    if island_model and (
+            not isinstance(evaluator, (type(None), SerialEvaluator)) or
+            fidelity_schedule or instrumentation):
+        raise ValueError(
+            "islands evaluate genomes serially in their own processes, so "
+            "other evaluators, fidelity schedules and instrumentation aren't "
+            "supported")
+
+    if fidelity_schedule:
+        evaluator = MultiFidelityEvaluator(evaluator, fidelity_schedule)
+
+    if artifact_writer.is_enabled("spectrogram"):
+        artifact_writer.submit(
+            "spectrogram",
+            analysis_cache.get_spectrogram(
+                reference_pcm_audio, persistent=True).to_tga_file,
+            "reference_spectrogram.tga")
+
+    if optimizer != "genetic" and (
+            island_model or early_abort or refinement_interval):
+        raise ValueError(
+            "island models, early abort and refinement require the genetic "
+            "optimizer")
+
+    algorithm = _algorithm_by_optimizer[optimizer]()
+    algorithm.instrumentation = instrumentation
+    if early_abort:
+        algorithm.early_abort = True
+    if refinement_interval:
+        algorithm.refinement_interval = refinement_interval
+    if generation_limit is not None:
+        algorithm.generation_limit = generation_limit
 
     best_score = None
     pcm_audio = None
+    base_pcm_audio = None
     sounds = []
 
-    if os.path.exists("base.wav"):
-        print "Using 'base.wav' as a base sound for additive sythesis"
-        pcm_audio = PcmAudio.from_wave_file("base.wav")
-
-    for index in xrange(20):
-
-        genome_factory = get_sound_factory(reference_pcm_audio, pcm_audio)
-        population = Population(genome_factory, 80)
-        best_sound = algorithm.run(population)
+    if seed is not None:
+        random.seed(seed)
+
+    if base_filename and os.path.exists(base_filename):
+        print "Using '%s' as a base sound for additive sythesis" % (
+            base_filename)
+        pcm_audio = PcmAudio.from_wave_file(base_filename)
+        base_pcm_audio = pcm_audio
+
+    for index in xrange(partial_count):
+
+        if instrumentation:
+            instrumentation.context["partial"] = index
+
+        score_cache = (
+            ScoreCache(score_cache_capacity, score_cache_resolution)
+            if score_cache_capacity else None)
+
+        genome_factory = get_sound_factory(
+            reference_pcm_audio, pcm_audio, evaluation_mode, spectral_engine,
+            analysis_cache, score_cache, initialization)
+        if island_model:
+            best_sound = island_model.run(
+                algorithm, genome_factory, 80,
+                ArrayPopulation if array_population else Population)
+        else:
+            if array_population:
+                population = ArrayPopulation(
+                    genome_factory, 80, evaluator,
+                    None if seed is None else seed + index)
+            else:
+                population = Population(genome_factory, 80, evaluator)
+            best_sound = algorithm.run(population)
+
+        if score_cache:
+            print "Score cache: %s" % score_cache
 
         if best_score is not None and best_sound.score < best_score:
             print "The algorithm failed to produce a better sound on this step"
@@ -36,19 +138,259 @@ def resynthesize(reference_pcm_audio):
 
         print best_sound
         pcm_audio = best_sound.to_pcm_audio()
-        pcm_audio.to_wave_file("debug%d.wav" % index)
-
-        Spectrogram(pcm_audio.samples).to_tga_file()
 
         best_score = best_sound.score
 
         sounds.append(best_sound)
 
-    construct_csound_file(sounds, pcm_audio)
+        if retuning_step_count and len(sounds) > 1:
+            pcm_audio, score_gain = retune_partials(
+                sounds, reference_pcm_audio, base_pcm_audio, evaluation_mode,
+                spectral_engine, analysis_cache, retuning_step_count)
+            best_score += score_gain
+
+        artifact_writer.submit(
+            "debug_wave", pcm_audio.to_wave_file, "debug%d.wav" % index)
+
+        # The spectrogram is computed here, because the analysis cache isn't
+        # thread-safe; the next partial needs it anyway
+        if artifact_writer.is_enabled("spectrogram"):
+            artifact_writer.submit(
+                "spectrogram",
+                analysis_cache.get_spectrogram(pcm_audio).to_tga_file)
+
+    if csound_filename:
+        construct_csound_file(sounds, pcm_audio, csound_filename)
+    if model_filename:
+        write_model_file(sounds, model_filename)
+
+    artifact_writer.flush()
 
     return pcm_audio
 
 
+def resynthesize_segments(
+        input_filename, output_filename, segment_duration=10.0,
+        overlap_duration=1.0, workers=None, model_directory=None, seed=None,
+        **resynthesis_arguments):
+    """ Resynthesizes a long recording by overlapping segments which are
+    resynthesized independently by 'resynthesize' with
+    'resynthesis_arguments' in 'workers' processes (a process per CPU by
+    default). Results are joined by linear crossfades in overlaps of
+    segments.
+
+    Segments are read from 'input_filename' and the result is written to
+    'output_filename' while segments are processed; at most two segments
+    per worker are in progress at once. So the memory depends on the
+    segment duration rather than on the length of the recording.
+
+    If 'model_directory' is specified then partials of the N-th segment are
+    exported there as 'segmentN.json' (see 'write_model_file') and
+    'segmentN.csd'. 'segments.json' lists start times and durations of all
+    segments in seconds and names of their files; silent segments have no
+    partials and no Csound files. """
+
+    sampling_rate, frame_count = read_wave_file_info(input_filename)
+
+    segment_length = int(round(segment_duration * sampling_rate))
+    overlap_length = int(round(overlap_duration * sampling_rate))
+    assert 0 <= overlap_length < segment_length, \
+        "The overlap must be shorter than a segment"
+
+    # The last segment is extended to the end of the recording, so it's
+    # never much shorter than the others
+    hop_size = segment_length - overlap_length
+    segment_count = max(
+        int(round(float(frame_count - overlap_length) / hop_size)), 1)
+    first_frames = [index * hop_size for index in xrange(segment_count)]
+    end_frames = [
+        first_frame + segment_length for first_frame in first_frames[:-1]]
+    end_frames.append(frame_count)
+
+    tasks = [
+        (input_filename, index, first_frame, end_frame - first_frame,
+         None if seed is None else seed + index, model_directory,
+         resynthesis_arguments)
+        for index, (first_frame, end_frame) in enumerate(
+            zip(first_frames, end_frames))]
+
+    if model_directory and not os.path.isdir(model_directory):
+        os.makedirs(model_directory)
+
+    workers = workers or multiprocessing.cpu_count()
+
+    # A new process per segment releases all memory of the previous one
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+
+    fade_in = numpy.linspace(0, 1, overlap_length + 2)[1:-1]
+    fade_out = fade_in[::-1]
+
+    try:
+        with WaveWriter(output_filename, sampling_rate) as writer:
+
+            pending_results = deque()
+            segments = []
+            tail = None
+
+            for index in xrange(segment_count):
+
+                while (len(pending_results) < 2 * workers and
+                       len(tasks) > index + len(pending_results)):
+                    pending_results.append(pool.apply_async(
+                        _resynthesize_segment,
+                        (tasks[index + len(pending_results)],)))
+
+                samples, has_partials = pending_results.popleft().get()
+                segments.append({
+                    "start": float(first_frames[index]) / sampling_rate,
+                    "duration": float(len(samples)) / sampling_rate,
+                    "model": "segment%d.json" % index,
+                    "csound":
+                        "segment%d.csd" % index if has_partials else None
+                })
+
+                if tail is not None:
+                    samples[:overlap_length] *= fade_in
+                    samples[:overlap_length] += tail * fade_out
+
+                if index + 1 < segment_count:
+                    tail = samples[len(samples) - overlap_length:]
+                    samples = samples[:len(samples) - overlap_length]
+
+                writer.write(samples)
+
+                print "Segment %d of %d is resynthesized" % (
+                    index + 1, segment_count)
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if model_directory:
+        index_filename = os.path.join(model_directory, "segments.json")
+        with open(index_filename, "w") as output_file:
+            json.dump(segments, output_file, indent=2, sort_keys=True)
+
+
+def _resynthesize_segment(task):
+
+    (input_filename, index, first_frame, frame_count, seed, model_directory,
+     resynthesis_arguments) = task
+
+    pcm_audio = PcmAudio.from_wave_file(
+        input_filename, first_frame=first_frame, frame_count=frame_count)
+
+    filename = (
+        os.path.join(model_directory, "segment%d" % index)
+        if model_directory else None)
+
+    analysis_cache = resynthesis_arguments.get("analysis_cache")
+
+    if not is_significant(pcm_audio, analysis_cache):
+        # There is nothing to approximate, the segment is silent
+        if filename:
+            write_model_file([], filename + ".json")
+        return numpy.zeros(len(pcm_audio.samples)), False
+
+    synthesized_pcm_audio = resynthesize(
+        pcm_audio, seed=seed, artifact_writer=ArtifactWriter("off"),
+        base_filename=None,
+        csound_filename=filename and filename + ".csd",
+        model_filename=filename and filename + ".json",
+        **resynthesis_arguments)
+
+    return (
+        numpy.asarray(synthesized_pcm_audio.samples, dtype=numpy.float64),
+        True)
+
+
+def retune_partials(
+        sounds, reference_pcm_audio, base_pcm_audio, evaluation_mode,
+        spectral_engine, analysis_cache, step_count):
+    """ Refines each of 'sounds' except the last one in place, keeping the
+    other partials fixed. Returns the sum of the base sound and all partials
+    and the gain of its score. A score of a partial added to all the other
+    partials is a score of the sum, so gains of partials add up.
+
+    The STFT is linear, so complex spectra of the sum of the base sound and
+    the other partials are the total spectra minus spectra of the re-tuned
+    partial. All partials are re-tuned by a single sound class which base is
+    replaced by these sums; only the partials themselves are analyzed. """
+
+    sound_factory = get_sound_factory(
+        reference_pcm_audio, base_pcm_audio, evaluation_mode,
+        spectral_engine, analysis_cache)
+
+    partial_spectra = numpy.array(sound_factory._get_spectra(
+        *sound_factory._get_parameters(sounds)))
+    spectra = sound_factory._base_spectra + partial_spectra.sum(axis=0)
+
+    partials = render_partials(sounds)
+    samples = partials.sum(axis=0)
+    if base_pcm_audio:
+        samples += base_pcm_audio.samples
+
+    evaluation_count = 0
+    score_gain = 0
+
+    for index, sound in enumerate(sounds[:-1]):
+
+        sound_factory.replace_base(
+            PcmAudio(reference_pcm_audio.sampling_rate,
+                     samples - partials[index]),
+            spectra - partial_spectra[index])
+
+        sound = sound_factory.from_genes(sound.get_genes())
+        score = sound.score
+        (refined_sound,), refinement_evaluation_count = sound_factory.refine(
+            [sound], step_count)
+        evaluation_count += refinement_evaluation_count + 1
+
+        if refined_sound.score > score:
+            score_gain += refined_sound.score - score
+            sounds[index] = refined_sound
+
+            spectra -= partial_spectra[index]
+            partial_spectra[index] = sound_factory._get_spectra(
+                *sound_factory._get_parameters([refined_sound]))[0]
+            spectra += partial_spectra[index]
+
+            samples -= partials[index]
+            partials[index] = render_partials([refined_sound])[0]
+            samples += partials[index]
+
+    print "Re-tuned %d partials with %d evaluations. Gain: %.2f" % (
+        len(sounds) - 1, evaluation_count, score_gain)
+
+    return (
+        PcmAudio(reference_pcm_audio.sampling_rate, samples), score_gain)
+
+
+def write_model_file(sounds, filename):
+    """ Writes parameters of partials as a JSON list of objects with the
+    frequency in Hz, the phase in radians, the score and points of the
+    amplitude envelope: '[time, value]' pairs where times are in seconds
+    from the start of the sound and values are in the scale of 16-bit
+    samples. """
+
+    model = []
+
+    for sound in sounds:
+        sound._sort_amplitude_envelope_points()
+        model.append({
+            "frequency": float(sound._frequency),
+            "phase": float(sound._phase),
+            "score": float(sound.score),
+            "envelope": [
+                [float(point.time), float(point.value)]
+                for point in sound._amplitude_envelope_points]
+        })
+
+    with open(filename, "w") as output_file:
+        json.dump(model, output_file, indent=2, sort_keys=True)
+
+
 def construct_csound_file(sounds, pcm_audio, filename="out.csd"):
 
     signed_short_max = 2**15 - 1
@@ -59,11 +401,9 @@ def construct_csound_file(sounds, pcm_audio, filename="out.csd"):
     # We assume that a frequency of a partial with the maximal energy is a base
     # sound frequency
 
-    def energy(sound):
-        sound._base_pcm_audio = None
-        return numpy.abs(sound.to_pcm_audio().samples).sum()
-
-    sounds = sorted(sounds, key=energy, reverse=True)
+    energies = numpy.abs(render_partials(sounds)).sum(axis=-1)
+    sounds = [
+        sounds[index] for index in numpy.argsort(-energies, kind="mergesort")]
 
     sound_frequency = sounds[0]._frequency
 
@@ -1,12 +1,17 @@
+import itertools
 import random
+import weakref
 
 import numpy
 
-from algorithm import Genome
+from algorithm import Genome, ScoreBound
+from analysis import default_analysis_cache, find_spectral_peaks
 from envelope import Envelope
-from oscillator import Oscillator
+from oscillator import OscillatorBank
 from pcm_audio import PcmAudio
-from spectrogram import Spectrogram
+from spectrogram import (
+    complex_stft, enveloped_sine_stft, stft, stft_shape, to_rfft_layout)
+from workspace import get_workspace
 
 
 def wrap_around(value, minimal_value, maximal_value):
@@ -18,6 +23,45 @@ def wrap_around(value, minimal_value, maximal_value):
     return value
 
 
+def wrap_around_array(values, minimal_values, maximal_values):
+    """ The vectorized version of 'wrap_around' """
+    values = numpy.where(
+        values < minimal_values, 2 * minimal_values - values, values)
+    return numpy.where(
+        values > maximal_values, 2 * maximal_values - values, values)
+
+
+# Sound classes created by 'get_sound_factory' are local classes and can't be
+# pickled. Instead they are registered here and sounds are pickled as a key of
+# their class and parameters. Worker processes register the same keys using
+# '_initialize_worker'.
+_sound_factories = weakref.WeakValueDictionary()
+_sound_factory_keys = itertools.count()
+
+# Frequencies which magnitudes never reach this value aren't approximated
+_minimal_significant_amplitude = 20.0
+
+
+def _restore_sound(factory_key, frequency, phase, points, score):
+    sound = _sound_factories[factory_key].__new__(
+        _sound_factories[factory_key])
+    Genome.__init__(sound)
+    sound._frequency = frequency
+    sound._phase = phase
+    sound._amplitude_envelope_points = [
+        Envelope.Point(time, value) for time, value in points]
+    sound.score = score
+    return sound
+
+
+def _initialize_worker(factory_key, factory_arguments):
+    global _worker_sound_factory
+    if factory_key not in _sound_factories:
+        # Keep a strong reference while the worker is alive
+        _worker_sound_factory = get_sound_factory(
+            factory_key=factory_key, **factory_arguments)
+
+
 class _Sound(Genome):
 
     _minimal_frequency = 40
@@ -25,6 +69,25 @@ class _Sound(Genome):
 
     _point_count = 5
 
+    # A number of genomes which are synthesized and analyzed together by
+    # 'evaluate_batch'. Memory consumption grows linearly with this value.
+    _evaluation_batch_size = 8
+
+    # A number of frequency bins at each side of the partial frequency which
+    # are taken into account in the "band" evaluation mode
+    _band_half_width = 32
+
+    # A number of frames which are evaluated at once when evaluation can be
+    # stopped early because of a cutoff
+    _abort_block_size = 8
+
+    # Sounds of an initial population which are seeded near peaks of the
+    # residual spectrogram: a probability to seed a sound and parameters of
+    # peaks (see 'get_sound_factory'). Peak frequencies are None when
+    # seeding is disabled.
+    _seeding_rate = 0.5
+    _seed_frequencies = None
+
     def __init__(self):
 
         Genome.__init__(self)
@@ -37,6 +100,21 @@ class _Sound(Genome):
             for _ in xrange(self._point_count)
         ]
 
+    @classmethod
+    def create_initial_genomes(cls, count):
+
+        if cls._seed_frequencies is None:
+            return [cls() for _ in xrange(count)]
+
+        # All seeded sounds share one random state seeded from the 'random'
+        # module
+        random_state = numpy.random.RandomState(random.getrandbits(32))
+        seeded_count = random_state.binomial(count, cls._seeding_rate)
+
+        return [cls() for _ in xrange(count - seeded_count)] + [
+            cls.from_genes(genes)
+            for genes in cls._seed_genes(seeded_count, random_state)]
+
     def mutate(self, rate):
 
         mutated = False
@@ -105,70 +183,647 @@ class _Sound(Genome):
         self._sort_amplitude_envelope_points()
         other._sort_amplitude_envelope_points()
 
-        first_child._amplitude_envelope_points = []
-        second_child._amplitude_envelope_points = []
+        times = []
+        amplitudes = []
 
         for self_point, other_point in zip(
                 self._amplitude_envelope_points,
                 other._amplitude_envelope_points):
 
-            first_time, second_time = child_value_pair(
+            times.append(child_value_pair(
                 self_point.time, other_point.time,
-                0, self._reference_pcm_audio.duration)
-
-            first_amplitude, second_amplitude = child_value_pair(
-                self_point.value, other_point.value, 0, self._maximal_amplitude)
+                0, self._reference_pcm_audio.duration))
 
-            first_amplitude = numpy.clip(
-                first_amplitude, 0,
-                self._amplitude_limit_envelope.get_output(first_time))
+            amplitudes.append(child_value_pair(
+                self_point.value, other_point.value, 0, self._maximal_amplitude))
 
-            second_amplitude = numpy.clip(
-                second_amplitude, 0,
-                self._amplitude_limit_envelope.get_output(second_time))
+        # Amplitude limits at times of all points are looked up at once
+        times = numpy.array(times)
+        amplitudes = numpy.clip(
+            amplitudes, 0, self._amplitude_limit_envelope.get_output(times))
 
-            first_child._amplitude_envelope_points.append(
-                Envelope.Point(first_time, first_amplitude))
-            second_child._amplitude_envelope_points.append(
-                Envelope.Point(second_time, second_amplitude))
+        first_child._amplitude_envelope_points = [
+            Envelope.Point(time, amplitude)
+            for time, amplitude in zip(times[:, 0], amplitudes[:, 0])]
+        second_child._amplitude_envelope_points = [
+            Envelope.Point(time, amplitude)
+            for time, amplitude in zip(times[:, 1], amplitudes[:, 1])]
 
         return first_child, second_child
 
+    # Genes of a sound are its frequency, phase, times of envelope points and
+    # values of envelope points. Points are always sorted by time.
+
+    @classmethod
+    def random_genes(cls, count, random_state):
+
+        times = random_state.uniform(
+            0, cls._reference_pcm_audio.duration, (count, cls._point_count))
+        values = random_state.uniform(0, 1, (count, cls._point_count))
+        values *= cls._amplitude_limit_envelope.get_output(times)
+
+        genes = cls._join_genes(
+            random_state.uniform(
+                cls._minimal_frequency, cls._maximal_frequency, count),
+            random_state.uniform(0, 2 * numpy.pi, count),
+            times, values)
+
+        if cls._seed_frequencies is not None:
+            seeded = random_state.rand(count) < cls._seeding_rate
+            genes[seeded] = cls._seed_genes(
+                numpy.count_nonzero(seeded), random_state)
+
+        return genes
+
+    @classmethod
+    def _seed_genes(cls, count, random_state):
+        """ Returns genes of 'count' sounds near peaks of the residual
+        spectrogram. Peaks are chosen with probabilities proportional to
+        their energies. """
+
+        peaks = random_state.choice(
+            len(cls._seed_frequencies), count, p=cls._seed_probabilities)
+
+        frequencies = numpy.clip(
+            cls._seed_frequencies[peaks] +
+                random_state.normal(0, cls._bin_width / 4, count),
+            cls._minimal_frequency, cls._maximal_frequency)
+
+        times = numpy.clip(
+            cls._seed_times[peaks] + random_state.normal(
+                0, cls._frame_length / 2, (count, cls._point_count)),
+            0, cls._reference_pcm_audio.duration)
+        values = numpy.minimum(
+            cls._seed_values[peaks] *
+                random_state.uniform(0.5, 1, (count, cls._point_count)),
+            cls._amplitude_limit_envelope.get_output(times))
+
+        return cls._join_genes(
+            frequencies, random_state.uniform(0, 2 * numpy.pi, count),
+            times, values)
+
+    @classmethod
+    def mutate_genes(cls, genes, rate, random_state):
+
+        count = len(genes)
+        frequencies, phases, times, values = cls._split_genes(genes)
+
+        def mutated_values(values, mask, minimal_values, maximal_values):
+            """ The gaussian mutation operator. """
+            mutated_values = wrap_around_array(
+                random_state.normal(
+                    values,
+                    numpy.abs(maximal_values - minimal_values) * (0.2 + rate)),
+                minimal_values,
+                maximal_values)
+            return numpy.where(mask, mutated_values, values)
+
+        frequency_mask = random_state.uniform(size=count) <= rate
+        frequencies = mutated_values(
+            frequencies, frequency_mask,
+            cls._minimal_frequency, cls._maximal_frequency)
+
+        phase_mask = random_state.uniform(size=count) <= rate
+        phases = mutated_values(phases, phase_mask, 0, 2 * numpy.pi)
+
+        point_mask = random_state.uniform(size=times.shape) <= rate
+        times = mutated_values(
+            times, point_mask, 0, cls._reference_pcm_audio.duration)
+        values = mutated_values(
+            values, point_mask, 0,
+            cls._amplitude_limit_envelope.get_output(times))
+
+        mutated = frequency_mask | phase_mask | point_mask.any(axis=1)
+
+        return cls._join_genes(frequencies, phases, times, values), mutated
+
+    @classmethod
+    def cross_genes(cls, first_genes, second_genes, random_state):
+
+        def child_values(
+                first_parent_values, second_parent_values,
+                minimal_values, maximal_values):
+
+            mean = (first_parent_values + second_parent_values) / 2
+            standard_deviation = abs(first_parent_values - mean)
+
+            return [
+                wrap_around_array(
+                    random_state.normal(mean, standard_deviation),
+                    minimal_values,
+                    maximal_values)
+                for _ in xrange(2)]
+
+        first_parent_genes = cls._split_genes(first_genes)
+        second_parent_genes = cls._split_genes(second_genes)
+
+        frequencies = child_values(
+            first_parent_genes[0], second_parent_genes[0],
+            cls._minimal_frequency, cls._maximal_frequency)
+
+        phases = child_values(
+            first_parent_genes[1], second_parent_genes[1], 0, 2 * numpy.pi)
+
+        times = child_values(
+            first_parent_genes[2], second_parent_genes[2],
+            0, cls._reference_pcm_audio.duration)
+
+        values = child_values(
+            first_parent_genes[3], second_parent_genes[3],
+            0, cls._maximal_amplitude)
+
+        values = [
+            numpy.clip(
+                child_values, 0,
+                cls._amplitude_limit_envelope.get_output(child_times))
+            for child_values, child_times in zip(values, times)]
+
+        return [
+            cls._join_genes(*child_genes)
+            for child_genes in zip(frequencies, phases, times, values)]
+
+    @classmethod
+    def get_gene_bounds(cls):
+        point_count = cls._point_count
+        return (
+            numpy.hstack((
+                cls._minimal_frequency, 0, numpy.zeros(2 * point_count))),
+            numpy.hstack((
+                cls._maximal_frequency, 2 * numpy.pi,
+                numpy.full(point_count, cls._reference_pcm_audio.duration),
+                numpy.full(point_count, cls._maximal_amplitude))))
+
+    @classmethod
+    def repair_genes(cls, genes):
+        frequencies, phases, times, values = cls._split_genes(genes)
+        times = numpy.clip(times, 0, cls._reference_pcm_audio.duration)
+        return cls._join_genes(
+            numpy.clip(
+                frequencies, cls._minimal_frequency, cls._maximal_frequency),
+            numpy.mod(phases, 2 * numpy.pi),
+            times,
+            numpy.clip(
+                values, 0, cls._amplitude_limit_envelope.get_output(times)))
+
+    @classmethod
+    def from_genes(cls, genes):
+        sound = cls.__new__(cls)
+        Genome.__init__(sound)
+        sound._set_genes(genes)
+        return sound
+
+    def _set_genes(self, genes):
+        frequencies, phases, times, values = self._split_genes(
+            genes[numpy.newaxis])
+        self._frequency = float(frequencies[0])
+        self._phase = float(phases[0])
+        self._amplitude_envelope_points = [
+            Envelope.Point(float(time), float(value))
+            for time, value in zip(times[0], values[0])]
+
+    def get_genes(self):
+        return self._join_genes(*self._get_parameters([self]))[0]
+
+    @classmethod
+    def _join_genes(cls, frequencies, phases, times, values):
+        """ Joins parameters of sounds into a matrix of genes and sorts
+        envelope points by time """
+        order = numpy.argsort(times, axis=1)
+        rows = numpy.arange(len(times))[:, numpy.newaxis]
+        return numpy.hstack((
+            frequencies[:, numpy.newaxis], phases[:, numpy.newaxis],
+            times[rows, order], values[rows, order]))
+
+    @classmethod
+    def _split_genes(cls, genes):
+        """ Returns frequencies, phases, times and values of envelope points of
+        sounds with the specified genes """
+        return (
+            genes[:, 0], genes[:, 1],
+            genes[:, 2:2 + cls._point_count], genes[:, 2 + cls._point_count:])
+
     def evaluate(self):
+        return self.evaluate_batch([self])[0]
+
+    @classmethod
+    def evaluate_batch(cls, genomes, fidelity=1.0, cutoff=None):
 
-        spectrogram = Spectrogram(self.to_pcm_audio().samples)
+        # A lower fidelity analyzes only a part of frames. Scores are means
+        # of frame ranks, so they keep their scale.
+        frame_step = max(1, int(round(1.0 / fidelity)))
 
-        ranks = []
+        scores = []
 
-        for magnitudes1, magnitudes2 in zip(
-                self._reference_spectrogram, spectrogram):
+        for start in xrange(0, len(genomes), cls._evaluation_batch_size):
+            batch = genomes[start:start + cls._evaluation_batch_size]
+            scores.extend(cls._evaluate_parameters(
+                *cls._get_parameters(batch), frame_step=frame_step,
+                cutoff=cutoff))
 
-            differences = magnitudes2 - magnitudes1
+        return scores
 
-            # The result is computed using the following formula:
-            # rank = sum(weights * differences**2)
+    @classmethod
+    def refine(cls, genomes, step_count):
+        """ Refines frequencies, phases and envelope values of the sounds by
+        the Levenberg-Marquardt method. Each step minimizes weighted squared
+        magnitude errors of the spectrogram (the ranks) in the Gauss-Newton
+        approximation and is accepted if it improves the score; otherwise
+        the damping grows. Times of envelope points are kept. """
 
-            rank = numpy.dot(
-                differences, differences * self._frequencies_weights)
-            ranks.append(rank)
+        assert cls._evaluation_mode in ("residual", "band"), \
+            "Refinement requires the residual or band evaluation mode"
 
-        return -numpy.mean(ranks)
+        refined_genomes = []
+        evaluation_count = 0
 
-    def to_pcm_audio(self):
+        for genome in genomes:
 
-        oscillator = Oscillator(self._frequency, self._phase)
-        envelope = Envelope()
-        for point in self._amplitude_envelope_points:
-            envelope.add_point(point)
+            genes = genome.get_genes()
+            score = genome.score
+            damping = 1e-2
+            equations = None
+
+            for _ in xrange(step_count):
+
+                frequencies, phases, times, values = cls._split_genes(
+                    genes[numpy.newaxis])
+
+                if equations is None:
+                    equations = cls._get_normal_equations(
+                        frequencies[0], phases[0], times[0], values[0])
+                matrix, gradient = equations
+
+                diagonal = numpy.diag(matrix)
+                diagonal = numpy.maximum(diagonal, 1e-12 * diagonal.max())
+                step = numpy.linalg.lstsq(
+                    matrix + damping * numpy.diag(diagonal), -gradient,
+                    rcond=None)[0]
+
+                candidate_genes = cls.repair_genes(cls._join_genes(
+                    frequencies + step[0], phases + step[1], times,
+                    values + step[2:]))
+                candidate_score = cls._evaluate_parameters(
+                    *cls._split_genes(candidate_genes))[0]
+                evaluation_count += 1
+
+                if candidate_score > score:
+                    genes, score = candidate_genes[0], candidate_score
+                    damping /= 10
+                    equations = None
+                else:
+                    damping *= 10
+
+            if score > genome.score:
+                genome = cls.from_genes(genes)
+                genome.score = score
+
+            refined_genomes.append(genome)
+
+        return refined_genomes, evaluation_count
+
+    @classmethod
+    def _get_normal_equations(cls, frequency, phase, times, values):
+        """ Returns the normal equations (a matrix and a vector) of the
+        Gauss-Newton method for weighted magnitude errors of a partial with
+        respect to its frequency, phase and envelope values """
+
+        point_count = len(values)
+        frequency_step = 1e-2 * cls._bin_width
+        phase_step = 1e-3
+
+        # Spectra are linear in envelope values, so spectra of envelopes with
+        # a single unit value are exact derivatives with respect to values.
+        # Derivatives with respect to the frequency and the phase are finite
+        # differences.
+        frequencies = numpy.full(point_count + 2, frequency)
+        frequencies[-2] += frequency_step
+        phases = numpy.full(point_count + 2, phase)
+        phases[-1] += phase_step
+
+        bins = None
+        base_spectra = cls._base_spectra
+        reference_magnitudes = cls._reference_magnitudes
+        weights = cls._frequencies_weights
+
+        if cls._evaluation_mode == "band":
+            band_bins = cls._get_band_bins(frequencies[:1])
+            bins = numpy.repeat(band_bins, point_count + 2, axis=0)
+            base_spectra = base_spectra[:, band_bins[0]]
+            reference_magnitudes = reference_magnitudes[:, band_bins[0]]
+            weights = weights[band_bins[0]]
+
+        spectra = cls._get_spectra(
+            frequencies, phases, numpy.tile(times, (point_count + 2, 1)),
+            numpy.vstack((numpy.eye(point_count), values, values)), bins)
+
+        value_derivatives = spectra[:point_count]
+
+        spectra_sum = numpy.tensordot(values, value_derivatives, 1)
+        spectra_sum += base_spectra
+        magnitudes = numpy.abs(spectra_sum)
+
+        weights = numpy.sqrt(weights)
+        residuals = weights * (magnitudes - reference_magnitudes)
+
+        jacobian = numpy.vstack((
+            [(numpy.abs(spectra[-2] + base_spectra) - magnitudes) /
+                frequency_step],
+            [(numpy.abs(spectra[-1] + base_spectra) - magnitudes) /
+                phase_step],
+            numpy.real(numpy.conj(spectra_sum) * value_derivatives) /
+                numpy.maximum(magnitudes, numpy.finfo(numpy.float64).tiny)))
+        jacobian *= weights
+        jacobian = jacobian.reshape(point_count + 2, -1)
+
+        return jacobian.dot(jacobian.T), jacobian.dot(residuals.ravel())
+
+    @classmethod
+    def _get_parameters(cls, genomes):
+        """ Returns parameters of the specified genomes as arrays: frequencies,
+        phases, envelope point times and envelope point values. Envelope
+        points of each genome are sorted by time. """
+
+        for genome in genomes:
+            genome._sort_amplitude_envelope_points()
+
+        frequencies = numpy.array([genome._frequency for genome in genomes])
+        phases = numpy.array([genome._phase for genome in genomes])
+        times = numpy.array([
+            [point.time for point in genome._amplitude_envelope_points]
+            for genome in genomes])
+        values = numpy.array([
+            [point.value for point in genome._amplitude_envelope_points]
+            for genome in genomes])
+
+        return frequencies, phases, times, values
 
-        samples = oscillator.get_output(self._sample_times)
-        samples *= envelope.get_output(self._sample_times)
+    @classmethod
+    def _synthesize(cls, frequencies, phases, times, values, add_base=True,
+                    sample_indices=slice(None), out=None):
+        """ Returns a matrix which rows are samples of sounds with the
+        specified parameters. Only samples selected by 'sample_indices' (a
+        slice or a sorted array of indices) are synthesized. The result is
+        written into 'out' if it's specified. """
+
+        samples = OscillatorBank(
+            frequencies, phases, envelope_times=times,
+            envelope_values=values).render(
+                cls._sample_times[sample_indices], out)
+
+        if add_base and cls._base_pcm_audio:
+            samples += numpy.asarray(
+                cls._base_pcm_audio.samples)[sample_indices]
+
+        return samples
+
+    @classmethod
+    def _analyze_synthesized(cls, analyze, frequencies, phases, times, values,
+                             add_base=True, frames=slice(None), offset=None):
+        """ Synthesizes sounds with the specified parameters and returns the
+        specified frames (a slice) of their spectrograms computed by
+        'analyze' ('stft' or 'complex_stft') with the optional 'offset' of
+        FFT results of these frames. Only samples of these frames are
+        synthesized. Samples and spectrograms are kept in buffers of the
+        thread workspace, so the result is valid until the next call. """
+
+        frame_size, overlapping_size = 4096, 2048
+        hop_size = frame_size - overlapping_size
+
+        sample_count = len(cls._sample_times)
+        frame_starts = numpy.arange(0, sample_count, hop_size)[frames]
+        frame_step = frames.step or 1
+
+        if hop_size * frame_step >= frame_size:
+            # Frames don't overlap, so they are analyzed as consecutive frames
+            # of their samples
+            sample_indices = numpy.add.outer(
+                frame_starts, numpy.arange(frame_size)).ravel()
+            sample_indices = sample_indices[sample_indices < sample_count]
+            synthesized_count = len(sample_indices)
+            overlapping_size, frame_step = 0, 1
+        else:
+            sample_indices = slice(
+                frame_starts[0],
+                min(frame_starts[-1] + frame_size, sample_count))
+            synthesized_count = sample_indices.stop - sample_indices.start
+
+        workspace = get_workspace()
+
+        samples = cls._synthesize(
+            frequencies, phases, times, values, add_base, sample_indices,
+            workspace.get("samples", (len(frequencies), synthesized_count)))
+
+        spectra = workspace.get(
+            "spectra",
+            stft_shape(samples.shape, frame_size, overlapping_size,
+                       frame_step=frame_step),
+            numpy.complex128 if analyze is complex_stft else numpy.float64)
+
+        return analyze(
+            samples, frame_size, overlapping_size, frame_step=frame_step,
+            out=spectra, offset=offset)[..., :len(frame_starts), :]
+
+    @classmethod
+    def _get_band_bins(cls, frequencies):
+        """ Returns a matrix which rows are indices of frequency bins around
+        the specified frequencies. The band is shifted near the spectrum edges,
+        so it always has '2 * _band_half_width + 1' distinct bins. """
+
+        bin_count = cls._reference_magnitudes.shape[-1]
+        band_width = min(2 * cls._band_half_width + 1, bin_count)
+
+        central_bins = numpy.rint(frequencies / cls._bin_width).astype(int)
+        first_bins = numpy.clip(
+            central_bins - cls._band_half_width, 0, bin_count - band_width)
+
+        return first_bins[:, numpy.newaxis] + numpy.arange(band_width)
+
+    @classmethod
+    def _get_spectra(
+            cls, frequencies, phases, times, values, bins=None,
+            frames=slice(None)):
+        """ Returns complex spectra of partials with the specified parameters
+        in the specified frames (a slice) and, optionally, frequency bins. The
+        result has the shape (genomes, frames, bins). Full spectra are always
+        computed using the FFT, which is much cheaper for all bins than the
+        analytic engine. """
+
+        if cls._spectral_engine == "analytic" and bins is not None:
+            return enveloped_sine_stft(
+                frequencies, phases, times, values, cls._sample_period,
+                len(cls._sample_times), bins, frames=frames)
+
+        spectra = cls._analyze_synthesized(
+            complex_stft, frequencies, phases, times, values, add_base=False,
+            frames=frames)
+
+        if bins is None:
+            return spectra
+
+        return spectra[
+            numpy.arange(len(bins))[:, numpy.newaxis, numpy.newaxis],
+            numpy.arange(spectra.shape[1])[:, numpy.newaxis],
+            bins[:, numpy.newaxis, :]]
+
+    @classmethod
+    def _get_band_ranks(cls, frequencies, phases, times, values, frames):
+
+        # A rank of a frame is the precomputed rank of the base sound with
+        # the contribution of the band bins replaced by the one of the base
+        # sound plus the partial
+
+        bins = cls._get_band_bins(frequencies)
+
+        spectra = cls._get_spectra(
+            frequencies, phases, times, values, bins, frames)
+        spectra += cls._base_spectra[frames, bins].swapaxes(0, 1)
+
+        differences = numpy.abs(
+            spectra, out=get_workspace().get("differences", spectra.shape))
+        differences -= cls._reference_magnitudes[frames, bins].swapaxes(0, 1)
+
+        numpy.square(differences, out=differences)
+        differences *= cls._frequencies_weights[bins][:, numpy.newaxis, :]
+
+        ranks = differences.sum(axis=-1)
+        ranks -= cls._base_errors[frames, bins].swapaxes(0, 1).sum(axis=-1)
+        ranks += cls._base_frame_errors[frames]
+
+        return ranks
 
-        if self._base_pcm_audio:
+    @classmethod
+    def _get_frame_ranks(cls, frequencies, phases, times, values, frames):
+        """ Returns a matrix of ranks of the specified frames (a slice) of
+        sounds with the specified parameters. Ranks are non-negative. """
+
+        if cls._evaluation_mode == "band":
+            return cls._get_band_ranks(
+                frequencies, phases, times, values, frames)
+
+        if cls._evaluation_mode == "residual":
+            # The STFT is linear, so the spectrum of a sum of the base sound
+            # and the partial is a sum of their spectra. FFT results of the
+            # base sound are computed once by 'get_sound_factory' and are
+            # added to the ones of the partial.
+            differences = cls._analyze_synthesized(
+                stft, frequencies, phases, times, values, add_base=False,
+                frames=frames, offset=cls._base_fft_result[frames])
+        else:
+            differences = cls._analyze_synthesized(
+                stft, frequencies, phases, times, values, frames=frames)
+
+        differences -= cls._reference_magnitudes[frames]
+
+        # The result is computed using the following formula:
+        # rank = sum(weights * differences**2)
+
+        return numpy.square(differences, out=differences).dot(
+            cls._frequencies_weights)
+
+    @classmethod
+    def _evaluate_parameters(
+            cls, frequencies, phases, times, values, frame_step=1,
+            cutoff=None):
+
+        if cutoff is None:
+            return -numpy.mean(cls._get_frame_ranks(
+                frequencies, phases, times, values,
+                slice(None, None, frame_step)), axis=-1)
+
+        # Ranks of frames are non-negative, so a sum of ranks of a part of
+        # frames bounds the score. Frames are evaluated in blocks and sounds
+        # which can't reach the cutoff are dropped after each block. Blocks
+        # where the base sound has the largest ranks are likely to have the
+        # largest ranks with a partial too, so they are evaluated first.
+
+        frame_count = len(xrange(0, len(cls._reference_magnitudes), frame_step))
+
+        first_frames = numpy.arange(0, frame_count, cls._abort_block_size)
+        block_ranks = numpy.add.reduceat(
+            cls._base_frame_errors[::frame_step], first_frames)
+
+        rank_sums = numpy.zeros(len(frequencies))
+        evaluated_frame_counts = numpy.zeros(len(frequencies), dtype=int)
+        active = numpy.arange(len(frequencies))
+
+        for first_frame in first_frames[numpy.argsort(-block_ranks)]:
+
+            last_frame = min(first_frame + cls._abort_block_size, frame_count)
+
+            rank_sums[active] += cls._get_frame_ranks(
+                frequencies[active], phases[active], times[active],
+                values[active],
+                slice(first_frame * frame_step, last_frame * frame_step,
+                      frame_step)).sum(axis=-1)
+            evaluated_frame_counts[active] += last_frame - first_frame
+
+            active = active[-rank_sums[active] / frame_count >= cutoff]
+            if not len(active):
+                break
+
+        return [
+            score if evaluated_frame_count == frame_count else
+                ScoreBound(score, frame_count - evaluated_frame_count)
+            for score, evaluated_frame_count in zip(
+                -rank_sums / frame_count, evaluated_frame_counts)]
+
+    def to_pcm_audio(self, add_base=True):
+
+        samples = render_partials([self])[0]
+
+        if add_base and self._base_pcm_audio:
             samples += self._base_pcm_audio.samples
 
         return PcmAudio(self._reference_pcm_audio.sampling_rate, samples)
 
+    @classmethod
+    def replace_base(cls, base_pcm_audio, base_spectra):
+        """ Replaces the base sound by 'base_pcm_audio' which complex spectra
+        are 'base_spectra'. Nothing is analyzed, so this is much cheaper than
+        a new factory when spectra of the base sound are known, e.g. as a
+        sum of spectra of partials. Only the residual and band modes are
+        supported. Scores of existing sounds aren't updated, and workers of
+        a process pool which are already initialized keep the old base. """
+
+        assert cls._evaluation_mode in ("residual", "band"), \
+            "Replacing the base requires the residual or band evaluation mode"
+        assert cls.score_cache is None, \
+            "Cached scores depend on the base sound"
+
+        _set_base(cls, base_pcm_audio, numpy.abs(base_spectra), base_spectra)
+        cls._factory_arguments = dict(
+            cls._factory_arguments, base_pcm_audio=base_pcm_audio)
+
+    @classmethod
+    def worker_initializer(cls):
+        return _initialize_worker, (cls._factory_key, cls._factory_arguments)
+
+    def __reduce__(self):
+        points = tuple(
+            (point.time, point.value)
+            for point in self._amplitude_envelope_points)
+        score = self.score if self.is_evaluated else None
+        return _restore_sound, (
+            self._factory_key, self._frequency, self._phase, points, score)
+
+    def get_cache_key(self, resolution):
+        """ The frequency is quantized relatively to the width of a frequency
+        bin and times of envelope points relatively to the length of a frame,
+        so keys don't get coarser with the frequency range or the duration of
+        the reference sound """
+
+        self._sort_amplitude_envelope_points()
+
+        quantize = lambda value, step: int(round(value / (step * resolution)))
+
+        return (
+            quantize(self._frequency, self._bin_width),
+            quantize(self._phase, 2 * numpy.pi),
+            tuple(
+                (quantize(point.time, self._frame_length),
+                 quantize(point.value, self._maximal_amplitude))
+                for point in self._amplitude_envelope_points))
+
     def _sort_amplitude_envelope_points(self):
         self._amplitude_envelope_points.sort(key=lambda point: point.time)
 
@@ -201,32 +856,228 @@ class _Sound(Genome):
         return random.uniform(0, 2 * numpy.pi)
 
 
-def get_sound_factory(reference_pcm_audio, base_pcm_audio=None):
+def render_partials(sounds, mode="exact", table_size=65536):
+    """ Returns a matrix which rows are samples of 'sounds' without the base
+    sound. Sounds may belong to different factories of the same reference
+    sound. See 'OscillatorBank' for 'mode' and 'table_size'. """
+
+    frequencies, phases, times, values = _Sound._get_parameters(sounds)
+
+    return OscillatorBank(
+        frequencies, phases, envelope_times=times, envelope_values=values,
+        mode=mode, table_size=table_size).render(sounds[0]._sample_times)
+
+
+def _find_seed_peaks(sound_class, residual_magnitudes, frame_length,
+                     peak_count=8):
+    """ Finds the strongest peaks of the residual spectrogram and stores
+    their frequencies, probabilities and envelopes in 'sound_class' """
+
+    peaks, energies = find_spectral_peaks(
+        residual_magnitudes, sound_class._frequencies_weights, peak_count,
+        int(numpy.ceil(
+            sound_class._minimal_frequency / sound_class._bin_width)),
+        int(sound_class._maximal_frequency / sound_class._bin_width))
+
+    if not len(peaks) or not energies.sum():
+        return
+
+    # Magnitudes of a sine wave are attenuated by the window when its
+    # frequency is between bins
+    bins = numpy.rint(peaks).astype(int)
+    curves = residual_magnitudes[:, bins].T / numpy.sinc(
+        peaks - bins)[:, numpy.newaxis]
+
+    # Envelope points are evenly spaced, but the point which is the nearest
+    # to the maximum of a curve is moved to the maximum
+
+    frame_times = frame_length * (numpy.arange(len(residual_magnitudes)) + 0.5)
+
+    times = numpy.tile(
+        numpy.linspace(
+            0, sound_class._reference_pcm_audio.duration,
+            sound_class._point_count),
+        (len(peaks), 1))
+    maximum_times = frame_times[curves.argmax(axis=1)]
+    times[
+        numpy.arange(len(peaks)),
+        numpy.abs(times - maximum_times[:, numpy.newaxis]).argmin(axis=1)] = \
+            maximum_times
+
+    sound_class._seed_frequencies = peaks * sound_class._bin_width
+    sound_class._seed_probabilities = energies / energies.sum()
+    sound_class._seed_times = times
+    sound_class._seed_values = numpy.array([
+        numpy.interp(point_times, frame_times, curve)
+        for point_times, curve in zip(times, curves)])
+
+
+def is_significant(pcm_audio, analysis_cache=None):
+    """ Returns whether any magnitude of the spectrogram of 'pcm_audio' is
+    large enough to be approximated by sounds of 'get_sound_factory' """
+    analysis_cache = analysis_cache or default_analysis_cache
+    return analysis_cache.get_spectrogram(
+        pcm_audio, persistent=True).magnitudes.max() >= \
+            _minimal_significant_amplitude
+
+
+def _set_base(sound_class, base_pcm_audio, base_magnitudes, base_spectra):
+    """ Sets attributes of 'sound_class' which depend on the base sound: its
+    samples, complex spectra (in the residual and band modes) and their FFT
+    results (in the residual mode), the amplitude limit envelope and errors of the base sound. 'base_magnitudes' and
+    'base_spectra' are the spectrogram and complex spectra of the base sound
+    or None if there is no base sound. Returns the residual spectrogram (the
+    reference minus the base sound). """
+
+    sound_class._base_pcm_audio = base_pcm_audio
+
+    if sound_class._evaluation_mode in ("residual", "band"):
+        sound_class._base_spectra = (
+            base_spectra if base_spectra is not None else
+            numpy.zeros(
+                sound_class._reference_magnitudes.shape, numpy.complex128))
+
+    if sound_class._evaluation_mode == "residual":
+        sound_class._base_fft_result = to_rfft_layout(
+            sound_class._base_spectra)
+
+    # Compute amplitude limit envelope
+
+    envelope = Envelope()
+
+    magnitudes = sound_class._reference_magnitudes
+    if base_magnitudes is not None:
+        magnitudes = magnitudes - base_magnitudes
+
+    for frame_index, value in enumerate(magnitudes.max(axis=-1)):
+        envelope.add_point(
+            Envelope.Point(
+                time=sound_class._frame_length * (frame_index + 0.5),
+                value=value))
+
+    sound_class._amplitude_limit_envelope = envelope
+
+    if sound_class._evaluation_mode == "band":
+        sound_class._base_errors = (
+            sound_class._frequencies_weights * numpy.square(
+                numpy.abs(sound_class._base_spectra) -
+                sound_class._reference_magnitudes))
+    else:
+        sound_class._base_errors = (
+            sound_class._frequencies_weights * numpy.square(
+                (base_magnitudes if base_magnitudes is not None else 0) -
+                sound_class._reference_magnitudes))
+
+    # Ranks of frames of the base sound itself
+    sound_class._base_frame_errors = sound_class._base_errors.sum(axis=-1)
+
+    return magnitudes
+
+
+def get_sound_factory(
+        reference_pcm_audio, base_pcm_audio=None, evaluation_mode="synthesis",
+        spectral_engine="fft", analysis_cache=None, score_cache=None,
+        initialization="random", seeding_rate=0.5, factory_key=None):
+    """ Returns a class of sounds which approximate the reference sound when
+    they are added to the base sound.
+
+    'evaluation_mode' defines how sounds are evaluated:
+    "synthesis" -- each sound is added to the base sound and the spectrogram
+    of the sum is compared with the reference spectrogram;
+    "residual" -- complex spectra of the base sound are computed once and
+    only a partial itself is analyzed during the evaluation. The evaluation
+    cost doesn't depend on the base sound. Scores are the same as in the
+    "synthesis" mode up to the floating point precision;
+    "band" -- the same as "residual" but a partial changes only the
+    '2 * _band_half_width + 1' bins around its frequency. Ranks of all the
+    other bins are taken from the precomputed ranks of the base sound.
+
+    The error of the "band" mode is bounded. A partial with the amplitude 'A'
+    leaks at most 'A / (pi * d)' into a bin which is 'd' bins away from its
+    frequency (the rectangular window). Ignoring a leakage 'c' changes a rank
+    of a bin by at most 'weight * c * (c + 2 * |base - reference|)' where
+    'base' and 'reference' are magnitudes of this bin. With the default
+    half width of 32 bins 'c' is about 1% of 'A' at most, and less than 1% of
+    the partial energy is ignored.
+
+    'spectral_engine' defines how spectra of partials are computed in the
+    "residual" and "band" modes: "fft" synthesizes partials and analyzes them
+    using the FFT, "analytic" computes only the band bins directly from
+    parameters of partials using 'enveloped_sine_stft', which is much
+    cheaper. The "analytic" engine requires the "band" mode: for all bins it
+    is several times slower than the FFT.
+
+    Analysis results are taken from 'analysis_cache' which defaults to
+    'analysis.default_analysis_cache'. Results which depend only on the
+    reference sound are requested as persistent.
+
+    'score_cache' is an optional 'ScoreCache' for sounds of the returned
+    class. Scores depend on the base sound, so a cache must not be shared
+    between factories.
+
+    'initialization' defines how sounds of an initial population are
+    created: "random" -- all parameters are random; "peaks" -- the
+    'seeding_rate' part of sounds is seeded near the strongest peaks of the
+    residual spectrogram (the reference minus the base sound) with envelopes
+    following magnitudes of the peak bins, the rest of sounds is random.
+    Genomes which are created by the constructor, e.g. by genetic
+    operators, are random. """
+
+    assert evaluation_mode in ("synthesis", "residual", "band"), \
+        "Unknown evaluation mode"
+    assert spectral_engine in ("fft", "analytic"), "Unknown spectral engine"
+    assert spectral_engine == "fft" or evaluation_mode == "band", \
+        "The analytic engine requires the band evaluation mode"
+    assert initialization in ("random", "peaks"), "Unknown initialization"
+
+    if factory_key is None:
+        factory_key = next(_sound_factory_keys)
+
+    analysis_cache = analysis_cache or default_analysis_cache
 
     class Sound(_Sound):
 
+        _factory_key = factory_key
+        _factory_arguments = dict(
+            reference_pcm_audio=reference_pcm_audio,
+            base_pcm_audio=base_pcm_audio,
+            evaluation_mode=evaluation_mode,
+            spectral_engine=spectral_engine,
+            initialization=initialization,
+            seeding_rate=seeding_rate)
+
+        _evaluation_mode = evaluation_mode
+        _spectral_engine = spectral_engine
+        _seeding_rate = seeding_rate
+
         _reference_pcm_audio = reference_pcm_audio
-        _reference_spectrogram = Spectrogram(reference_pcm_audio.samples)
+        _reference_spectrogram = analysis_cache.get_spectrogram(
+            reference_pcm_audio, persistent=True)
+        _reference_magnitudes = _reference_spectrogram.magnitudes
         _base_pcm_audio = base_pcm_audio
-        _maximal_amplitude = numpy.max(
-            [magnitudes.max() for magnitudes in _reference_spectrogram])
+        _maximal_amplitude = _reference_magnitudes.max()
 
-        _sample_times = numpy.linspace(
-            0, reference_pcm_audio.duration, len(reference_pcm_audio.samples))
+        _sample_times = analysis_cache.get_sample_times(reference_pcm_audio)
+        _frame_length = (
+            reference_pcm_audio.duration / len(_reference_magnitudes))
+        _sample_period = reference_pcm_audio.duration / (
+            len(reference_pcm_audio.samples) - 1)
 
-    base_sound_spectrogram = (
-        Spectrogram(base_pcm_audio.samples) if base_pcm_audio else None)
+    Sound.score_cache = score_cache
 
-    # Compute and overwrite maximal frequency
+    base_sound_spectrogram = (
+        analysis_cache.get_spectrogram(base_pcm_audio)
+        if base_pcm_audio else None)
 
-    minimal_significant_amplitude = 20.0
+    base_spectra = (
+        analysis_cache.get_complex_stft(base_pcm_audio)
+        if base_pcm_audio and evaluation_mode in ("residual", "band") else
+        None)
 
-    significant_frequency_indices = [
-        index for index, amplitudes in enumerate(
-            zip(*Sound._reference_spectrogram))
-        if numpy.max(amplitudes) >= minimal_significant_amplitude]
+    # Compute and overwrite maximal frequency
 
-    maximal_frequency_index = numpy.max(significant_frequency_indices)
+    maximal_frequency_index = analysis_cache.get_maximal_frequency_index(
+        reference_pcm_audio, _minimal_significant_amplitude, persistent=True)
 
     Sound._maximal_frequency = Sound._reference_spectrogram.get_frequencies(
         Sound._reference_pcm_audio.sampling_rate)[maximal_frequency_index]
@@ -238,7 +1089,7 @@ def get_sound_factory(reference_pcm_audio, base_pcm_audio=None):
     #     significant_base_frequency_indices = [
     #         index for index, amplitudes in enumerate(
     #             zip(*base_sound_spectrogram))
-    #         if numpy.max(amplitudes) >= minimal_significant_amplitude]
+    #         if numpy.max(amplitudes) >= _minimal_significant_amplitude]
 
     #     minimal_frequency_index = numpy.min([
     #         index for index in significant_frequency_indices
@@ -248,39 +1099,23 @@ def get_sound_factory(reference_pcm_audio, base_pcm_audio=None):
     #         base_pcm_audio.sampling_rate)[minimal_frequency_index]
     #     print Sound._minimal_frequency
 
-    # Compute amplitude limit envelope
-
-    envelope = Envelope()
+    # Compute weights by frequencies
 
-    frame_length = (
-        Sound._reference_pcm_audio.duration / len(Sound._reference_spectrogram))
+    Sound._frequencies_weights = analysis_cache.get_frequency_weights(
+        Sound._reference_pcm_audio.sampling_rate)
 
-    for frame_index, magnitudes in enumerate(Sound._reference_spectrogram):
-        if base_sound_spectrogram:
-            magnitudes = magnitudes - base_sound_spectrogram[frame_index]
-        envelope.add_point(
-            Envelope.Point(
-                time=frame_length * (frame_index + 0.5),
-                value=numpy.max(magnitudes)
-            )
-        )
+    Sound._bin_width = Sound._reference_spectrogram.get_frequencies(
+        Sound._reference_pcm_audio.sampling_rate)[1]
 
-    Sound._amplitude_limit_envelope = envelope
+    magnitudes = _set_base(
+        Sound, base_pcm_audio,
+        base_sound_spectrogram.magnitudes if base_sound_spectrogram else None,
+        base_spectra)
 
-    # Compute weights by frequencies
+    if initialization == "peaks":
+        _find_seed_peaks(
+            Sound, numpy.maximum(magnitudes, 0), Sound._frame_length)
 
-    def weight_by_frequency(frequency):
-        """ To calculate weights this function uses a technique called
-        "A-weighting" """
-        return (12200 ** 2) * (frequency ** 4) / (
-            (frequency ** 2 + 20.6 ** 2) *
-            numpy.sqrt(frequency ** 2 + 107.7 ** 2) *
-            numpy.sqrt(frequency ** 2 + 737.9 ** 2) *
-            (frequency ** 2 + 12200 ** 2)
-        )
-
-    Sound._frequencies_weights = numpy.array(
-        map(weight_by_frequency, Sound._reference_spectrogram.get_frequencies(
-            Sound._reference_pcm_audio.sampling_rate)))
+    _sound_factories[factory_key] = Sound
 
     return Sound
@@ -1,18 +1,17 @@
 from colorsys import hsv_to_rgb
 import struct
+import zlib
 
 import numpy
+from numpy.lib.stride_tricks import as_strided
 import scipy.fftpack
 
+from workspace import get_workspace
 
-def spectrum(signal, fft_length=None):
 
-    signal = numpy.array(signal, dtype=numpy.float64)
-
-    if not fft_length:
-        fft_length = len(signal)
-
-    fft_result = scipy.fftpack.rfft(signal, fft_length, overwrite_x=True)
+def _magnitudes(fft_result, fft_length, out=None):
+    """ Converts the result of 'scipy.fftpack.rfft' into scaled magnitudes.
+    'fft_result' is overwritten. """
 
     # From the documentation for scipy.fftpack.rfft:
     # The returned real arrays contains:
@@ -20,24 +19,385 @@ def spectrum(signal, fft_length=None):
 
     assert fft_length % 2 == 0, "'fft_length' is not even"
 
-    real_parts = fft_result[1:-1:2]
-    imaginary_parts = fft_result[2::2]
+    if out is None:
+        out = numpy.empty(fft_result.shape[:-1] + (fft_length / 2 + 1,))
+
+    squares = numpy.square(fft_result, out=fft_result)
 
-    magnitudes = numpy.sqrt(
-        numpy.square(real_parts, out=real_parts) +
-        numpy.square(imaginary_parts, out=imaginary_parts)
-    )
-    magnitudes = numpy.concatenate(
-        (abs(fft_result[:1]), magnitudes, abs(fft_result[-1:])))
+    numpy.add(squares[..., 1:-1:2], squares[..., 2::2], out=out[..., 1:-1])
+    out[..., 0] = squares[..., 0]
+    out[..., -1] = squares[..., -1]
+    numpy.sqrt(out, out=out)
 
     # Scale magnitudes. This allows to use them as amplitudes of sine waves
     # during the proccess of sound synthesis (now it's used only to calculate
     # the maximal possible amplitude).
-    magnitudes /= fft_length / 2
-    magnitudes[0] /= 2
-    magnitudes[-1] /= 2
+    out /= fft_length / 2
+    out[..., 0] /= 2
+    out[..., -1] /= 2
+
+    return out
+
+
+def _complex_spectra(fft_result, fft_length, out=None):
+    """ Converts the result of 'scipy.fftpack.rfft' into complex spectra
+    scaled as magnitudes returned by '_magnitudes' """
+
+    assert fft_length % 2 == 0, "'fft_length' is not even"
+
+    if out is None:
+        result = numpy.zeros(
+            fft_result.shape[:-1] + (fft_length / 2 + 1,),
+            dtype=numpy.complex128)
+    else:
+        result = out
+        result.imag[..., 0] = 0
+        result.imag[..., -1] = 0
+    result.real[..., 0] = fft_result[..., 0]
+    result.real[..., 1:-1] = fft_result[..., 1:-1:2]
+    result.imag[..., 1:-1] = fft_result[..., 2::2]
+    result.real[..., -1] = fft_result[..., -1]
+
+    result /= fft_length / 2
+    result[..., 0] /= 2
+    result[..., -1] /= 2
+
+    return result
+
+
+def to_rfft_layout(spectra, fft_length=4096):
+    """ Converts complex spectra scaled as the ones returned by
+    'complex_stft' into the layout and the scale of the result of
+    'scipy.fftpack.rfft', so they can be added to FFT results of frames (see
+    'offset' of 'stft') """
+
+    assert fft_length % 2 == 0, "'fft_length' is not even"
+
+    result = numpy.empty(spectra.shape[:-1] + (fft_length,))
+    result[..., 0] = spectra.real[..., 0] * fft_length
+    result[..., 1:-1:2] = spectra.real[..., 1:-1] * (fft_length / 2)
+    result[..., 2::2] = spectra.imag[..., 1:-1] * (fft_length / 2)
+    result[..., -1] = spectra.real[..., -1] * fft_length
+
+    return result
+
+
+def spectrum(signal, fft_length=None, out=None):
+    """ Calculates magnitudes of the spectrum of the specified 'signal'. If the
+    'signal' is a multidimensional array then spectra are calculated along the
+    last axis. If 'out' is specified then magnitudes are written into it and
+    the FFT is computed in a buffer of the thread workspace. """
+
+    if out is None:
+        signal = numpy.array(signal, dtype=numpy.float64)
+    else:
+        signal_copy = get_workspace().get("spectrum", numpy.shape(signal))
+        signal_copy[...] = signal
+        signal = signal_copy
+
+    if not fft_length:
+        fft_length = signal.shape[-1]
+
+    return _magnitudes(
+        scipy.fftpack.rfft(signal, fft_length, overwrite_x=True), fft_length,
+        out)
+
+
+def complex_spectrum(signal, fft_length=None):
+    """ Calculates the complex spectrum of the specified 'signal' along the
+    last axis. The spectrum is scaled exactly as the one returned by
+    'spectrum', so 'abs(complex_spectrum(signal))' equals 'spectrum(signal)'.
+    """
+
+    signal = numpy.array(signal, dtype=numpy.float64)
+
+    if not fft_length:
+        fft_length = signal.shape[-1]
+
+    return _complex_spectra(
+        scipy.fftpack.rfft(signal, fft_length, overwrite_x=True), fft_length)
+
+
+def stft_shape(signals_shape, frame_size=4096, overlapping_size=2048,
+               fft_length=4096, frame_step=1):
+    """ Returns the shape of the result of 'stft' for signals with the
+    specified shape """
+    frame_count = len(xrange(
+        0, signals_shape[-1], (frame_size - overlapping_size) * frame_step))
+    return tuple(signals_shape[:-1]) + (frame_count, fft_length / 2 + 1)
+
+
+def _frames(signals, frame_size, overlapping_size, frame_step=1, out=None):
+    """ Splits 'signals' into overlapping frames along the last axis. Returns
+    a new contiguous array or 'out', the last frames are padded with zeros.
+    Only each 'frame_step'-th frame is returned. """
+
+    signals = numpy.asarray(signals)
+
+    step = frame_size - overlapping_size
+    length = signals.shape[-1]
+    frame_starts = xrange(0, length, step * frame_step)
+    full_frame_count = (
+        (length - frame_size) // (step * frame_step) + 1
+        if length >= frame_size else 0)
+
+    frames = out if out is not None else numpy.empty(
+        signals.shape[:-1] + (len(frame_starts), frame_size))
+
+    # Frames which are entirely inside signals are copied from a strided view
+    sample_stride = signals.strides[-1]
+    frames[..., :full_frame_count, :] = as_strided(
+        signals,
+        shape=signals.shape[:-1] + (full_frame_count, frame_size),
+        strides=signals.strides[:-1] + (
+            step * frame_step * sample_stride, sample_stride))
+
+    for frame_index in xrange(full_frame_count, len(frame_starts)):
+        frame_start = frame_starts[frame_index]
+        frame_length = length - frame_start
+        frames[..., frame_index, :frame_length] = signals[..., frame_start:]
+        frames[..., frame_index, frame_length:] = 0
+
+    return frames
+
+
+def _stft_frames(signals, frame_size, overlapping_size, frame_step, out):
+    """ Returns frames of 'signals' for the FFT. If the result of the STFT is
+    written into 'out' then frames are kept in a buffer of the thread
+    workspace. """
+
+    if out is None:
+        return _frames(signals, frame_size, overlapping_size, frame_step)
+
+    frames = get_workspace().get(
+        "stft_frames", out.shape[:-1] + (frame_size,))
+
+    return _frames(signals, frame_size, overlapping_size, frame_step, frames)
+
+
+def _frames_fft(signals, frame_size, overlapping_size, fft_length,
+                frame_step, out, offset):
+    """ Returns FFT results of frames of 'signals' with 'offset' added to
+    the first frames """
+
+    fft_result = scipy.fftpack.rfft(
+        _stft_frames(signals, frame_size, overlapping_size, frame_step, out),
+        fft_length, overwrite_x=True)
+
+    if offset is not None:
+        fft_result[..., :len(offset), :] += offset
+
+    return fft_result
+
+
+def stft(signals, frame_size=4096, overlapping_size=2048, fft_length=4096,
+         frame_step=1, out=None, offset=None):
+    """ Calculates magnitude spectrograms of one or several signals at once
+    using a single FFT call. The last axis of 'signals' is a time axis. The
+    result has the shape returned by 'stft_shape':
+    'signals.shape[:-1] + (frame_count, fft_length / 2 + 1)'. The last frames
+    are padded with zeros. If 'frame_step' is greater than one then only each
+    'frame_step'-th frame is analyzed. The result is written into 'out' if
+    it's specified.
+
+    'offset' is optional FFT results (see 'to_rfft_layout') which are added
+    to the ones of the first frames of each signal. The STFT is linear, so
+    this gives spectrograms of sums of the signals and another signal which
+    spectra are known without synthesizing or analyzing the sums. """
+    return _magnitudes(
+        _frames_fft(
+            signals, frame_size, overlapping_size, fft_length, frame_step,
+            out, offset),
+        fft_length, out)
+
 
-    return magnitudes
+def complex_stft(
+        signals, frame_size=4096, overlapping_size=2048, fft_length=4096,
+        frame_step=1, out=None, offset=None):
+    """ The same as 'stft' but returns complex spectra """
+    return _complex_spectra(
+        _frames_fft(
+            signals, frame_size, overlapping_size, fft_length, frame_step,
+            out, offset),
+        fft_length, out)
+
+
+def _dirichlet_kernel(counts, angles, half_angle_sines, half_angle_cosines):
+    """ Returns 'F(angle) = sum(cos(v * angle))' and its derivative where 'v'
+    runs over 'counts' numbers with the unit step which are symmetric around
+    zero. 'angles' must be in [-pi, pi]. Near zero the closed form loses
+    precision, so the Taylor series is used there. """
+
+    squares_sum = counts * (counts ** 2 - 1) / 12
+    fourth_powers_sum = squares_sum * (3 * counts ** 2 - 7) / 20
+
+    small = numpy.abs(counts * angles) < 1e-2
+
+    half_angle_sines = numpy.where(small, 1.0, half_angle_sines)
+    sines = numpy.sin(counts * angles / 2)
+    cosines = numpy.cos(counts * angles / 2)
+
+    kernel = numpy.where(
+        small,
+        counts - angles ** 2 / 2 * squares_sum +
+            angles ** 4 / 24 * fourth_powers_sum,
+        sines / half_angle_sines)
+
+    derivative = numpy.where(
+        small,
+        -angles * squares_sum + angles ** 3 / 6 * fourth_powers_sum,
+        (counts * cosines * half_angle_sines - sines * half_angle_cosines) /
+            (2 * half_angle_sines ** 2))
+
+    return kernel, derivative
+
+
+def enveloped_sine_stft(
+        frequencies, phases, times, values, sample_period, sample_count,
+        bins=None, frame_size=4096, overlapping_size=2048, fft_length=4096,
+        frames=slice(None)):
+    """ Calculates complex spectrograms of sine waves with piecewise linear
+    amplitude envelopes analytically, without synthesizing the waves. A wave
+    is 'envelope(t) * sin(2 * pi * frequency * t + phase)' sampled at
+    't = n * sample_period' for 'n' in [0, sample_count). The envelope
+    interpolates points ('times', 'values') linearly and is constant outside
+    of them like 'numpy.interp' does. Times of points must be sorted.
+
+    The spectrum of a frame is a sum over envelope segments which intersect
+    the frame. For a linear segment the sum of the DFT terms is expressed via
+    the Dirichlet kernel and its derivative, so the cost doesn't depend on the
+    frame size. The result equals 'complex_stft' of the synthesized waves up
+    to the floating point precision.
+
+    'bins' is an optional matrix with indices of frequency bins to calculate
+    for each wave. The result has the shape (waves, frames, bins). 'frames'
+    is a slice of frames to calculate. """
+
+    assert fft_length >= frame_size, "Frames can't be truncated"
+
+    frequencies = numpy.asarray(frequencies, dtype=numpy.float64)
+    phases = numpy.asarray(phases, dtype=numpy.float64)
+    times = numpy.asarray(times, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+
+    if bins is None:
+        bins = numpy.arange(fft_length / 2 + 1)[numpy.newaxis]
+
+    step = frame_size - overlapping_size
+    frame_starts = numpy.arange(
+        0, sample_count, step, dtype=numpy.float64)[frames]
+    frame_ends = numpy.minimum(frame_starts + frame_size, sample_count)
+
+    # Envelope segments in sample units. The first and the last segments are
+    # constant and unbounded.
+
+    positions = times / sample_period
+    infinities = numpy.full((len(positions), 1), numpy.inf)
+
+    first_indices = numpy.ceil(numpy.hstack((-infinities, positions)))
+    last_indices = numpy.ceil(numpy.hstack((positions, infinities))) - 1
+
+    position_differences = numpy.diff(positions, axis=-1)
+    slopes = numpy.diff(values, axis=-1) / numpy.where(
+        position_differences > 0, position_differences, numpy.inf)
+    zeros = numpy.zeros((len(positions), 1))
+    slopes = numpy.hstack((zeros, slopes, zeros))
+
+    anchors = numpy.hstack((positions[:, :1], positions))
+    anchor_values = numpy.hstack((values[:, :1], values))
+
+    # Intersections of segments and frames, the shape is
+    # (waves, frames, segments)
+
+    lower_indices = numpy.maximum(
+        first_indices[:, numpy.newaxis, :],
+        frame_starts[numpy.newaxis, :, numpy.newaxis])
+    upper_indices = numpy.minimum(
+        last_indices[:, numpy.newaxis, :],
+        frame_ends[numpy.newaxis, :, numpy.newaxis] - 1)
+
+    counts = numpy.maximum(upper_indices - lower_indices + 1, 0)
+
+    # Each frame intersects only a few segments, so the computation is
+    # performed for non-empty intersections only. Samples of a frame always
+    # belong to some segment, so each frame has at least one intersection.
+    # Intersections are ordered by waves and frames.
+
+    waves, frames, segments = numpy.nonzero(counts)
+    frame_first_intersections = numpy.flatnonzero(numpy.hstack((
+        True, (numpy.diff(waves) != 0) | (numpy.diff(frames) != 0))))
+
+    centers = ((lower_indices + upper_indices) / 2)[waves, frames, segments]
+    segment_slopes = slopes[waves, segments]
+    center_values = anchor_values[waves, segments] + (
+        segment_slopes * (centers - anchors[waves, segments]))
+    centers -= frame_starts[frames]
+
+    counts = counts[waves, frames, segments][:, numpy.newaxis]
+    centers = centers[:, numpy.newaxis]
+    center_values = center_values[:, numpy.newaxis]
+    segment_slopes = segment_slopes[:, numpy.newaxis]
+
+    # sin(x) = (exp(ix) - exp(-ix)) / 2i, so the spectrum is a difference of
+    # two sums with complex exponents
+
+    angular_frequencies = 2 * numpy.pi * frequencies * sample_period
+    bin_angles = 2 * numpy.pi * bins / float(fft_length)
+
+    frame_phases = numpy.exp(1j * (
+        angular_frequencies[waves] * frame_starts[frames] +
+        phases[waves]))[:, numpy.newaxis]
+
+    terms = 0
+
+    for sign, frame_phase_factors in (
+            (1, frame_phases), (-1, -numpy.conj(frame_phases))):
+
+        angles = sign * angular_frequencies[:, numpy.newaxis] - bin_angles
+        angles = numpy.mod(angles + numpy.pi, 2 * numpy.pi) - numpy.pi
+
+        kernel, derivative = _dirichlet_kernel(
+            counts, angles[waves], numpy.sin(angles / 2)[waves],
+            numpy.cos(angles / 2)[waves])
+        angles = angles[waves]
+
+        terms = terms + frame_phase_factors * numpy.exp(
+            1j * angles * centers) * (
+                center_values * kernel - 1j * segment_slopes * derivative)
+
+    result = numpy.add.reduceat(terms, frame_first_intersections).reshape(
+        len(frequencies), len(frame_starts), -1)
+
+    result /= 2j
+
+    # Scale spectra exactly as 'complex_spectrum' does
+    result /= numpy.where(
+        (bins == 0) | (bins == fft_length / 2),
+        float(fft_length), fft_length / 2.)[:, numpy.newaxis, :]
+
+    return result
+
+
+def _reduce_by_maxima(matrix, shape):
+    """ Reduces dimensions of 'matrix' which exceed 'shape' (None means no
+    limit) by replacing blocks of elements with their maxima """
+
+    for axis, size in enumerate(shape):
+        length = matrix.shape[axis]
+        if size is not None and length > size:
+            block_size = -(-length // size)
+            matrix = numpy.maximum.reduceat(
+                matrix, numpy.arange(0, length, block_size), axis=axis)
+
+    return matrix
+
+
+# Colors of hues from 0 to 1
+_colormap = numpy.array([
+    [int(channel * 255) for channel in hsv_to_rgb(hue, 1, 1)]
+    for hue in numpy.linspace(0, 1, 256)], dtype=numpy.uint8)
+
+_maximal_tga_size = 2 ** 16 - 1
 
 
 class Spectrogram(object):
@@ -47,14 +407,24 @@ class Spectrogram(object):
         """ This function uses short-time Fourier transform (STFT) to calculate
         a spectrogram of the specified 'signal'. """
 
-        frame_starts = xrange(0, len(signal), frame_size - overlapping_size)
-
-        self.__spectrogram = [
-            spectrum(signal[frame_start:frame_start + frame_size], fft_length)
-                for frame_start in frame_starts]
+        self.__spectrogram = stft(
+            signal, frame_size, overlapping_size, fft_length)
 
         self.__fft_length = fft_length
 
+    @classmethod
+    def from_magnitudes(cls, magnitudes, fft_length=4096):
+        """ Creates a spectrogram from a precomputed matrix of magnitudes """
+        spectrogram = cls.__new__(cls)
+        spectrogram.__spectrogram = magnitudes
+        spectrogram.__fft_length = fft_length
+        return spectrogram
+
+    @property
+    def magnitudes(self):
+        """ A matrix of magnitudes with a row per frame """
+        return self.__spectrogram
+
     def __getitem__(self, key):
         return self.__spectrogram[key]
 
@@ -67,23 +437,31 @@ class Spectrogram(object):
     def get_frequencies(self, sampling_rate):
         return numpy.linspace(0, 0.5, self.__fft_length / 2 + 1) * sampling_rate
 
-    def to_tga_file(self, filename="out.tga"):
+    def to_pixels(self, width=None, height=None):
+        """ Returns an image of the spectrogram as a matrix of RGB colors with
+        a row per frame and a column per frequency bin. Logarithms of
+        magnitudes are mapped to hues. If the spectrogram is larger than
+        'width' or 'height' then it's reduced by taking maxima of blocks of
+        magnitudes, so peaks don't disappear. """
 
-        # TODO: rewrite this
+        magnitudes = _reduce_by_maxima(self.__spectrogram, (height, width))
 
-        maximal_magnitude = numpy.max(
-            [magnitudes.max() for magnitudes in self.__spectrogram])
+        levels = numpy.log10(magnitudes + 1)
+        maximal_level = levels.max() if levels.size else 0
+        if maximal_level > 0:
+            levels *= (len(_colormap) - 1) / maximal_level
 
-        db = lambda value: numpy.log10(value + 1)
+        return _colormap[numpy.rint(levels).astype(numpy.intp)]
 
-        def magnitude_to_color(magnitude):
-            r, g, b = hsv_to_rgb(
-                max(0, db(magnitude) / db(maximal_magnitude)), 1, 1)
-            return int(r * 255), int(g * 255), int(b * 255)
+    def to_tga_file(self, filename="out.tga", width=None, height=None):
+        """ Writes the image of the spectrogram (see 'to_pixels'), the first
+        frame is at the bottom. The format limits the height to 65535
+        frames, so larger spectrograms are always reduced. """
 
-        pixels = [
-            [magnitude_to_color(magnitude) for magnitude in magnitudes]
-                for magnitudes in self.__spectrogram]
+        height = min(height or _maximal_tga_size, _maximal_tga_size)
+        width = min(width or _maximal_tga_size, _maximal_tga_size)
+
+        pixels = self.to_pixels(width, height)
 
         with open(filename, "wb") as output:
 
@@ -92,20 +470,44 @@ class Spectrogram(object):
             image_type = 2 # 24-bit, uncompressed, no color map
             x_origin = 0
             y_origin = 0
-            width = len(pixels[0])
-            height = len(pixels)
             color_depth = 24
             image_descriptor = 0
 
             header = struct.pack(
                 "<BBB5BHHHHBB",
                 image_id_field_length, color_map_type, image_type,
-                0, 0, 0, 0, 0, x_origin, y_origin, width, height,
-                color_depth, image_descriptor)
+                0, 0, 0, 0, 0, x_origin, y_origin, pixels.shape[1],
+                pixels.shape[0], color_depth, image_descriptor)
 
             output.write(header)
+            # Colors are stored in the BGR order
+            output.write(pixels[..., ::-1].tostring())
+
+    def to_png_file(self, filename="out.png", width=None, height=None,
+                    compression_level=1):
+        """ Writes the image of the spectrogram (see 'to_pixels') in the same
+        orientation as 'to_tga_file'. 'compression_level' is a 'zlib' level,
+        the fastest one by default. """
 
-            for row in pixels:
-                for pixel in row:
-                    output.write(
-                        struct.pack("<3B", pixel[0], pixel[1], pixel[2]))
+        pixels = self.to_pixels(width, height)[::-1]
+        height, width = pixels.shape[:2]
+
+        # Each row starts with a filter type, 0 means no filter
+        rows = numpy.zeros((height, 1 + 3 * width), numpy.uint8)
+        rows[:, 1:] = pixels.reshape(height, -1)
+
+        def chunk(chunk_type, data):
+            return "".join((
+                struct.pack(">I", len(data)), chunk_type, data,
+                struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)))
+
+        bit_depth = 8
+        color_type = 2 # RGB
+
+        with open(filename, "wb") as output:
+            output.write("\x89PNG\r\n\x1a\n")
+            output.write(chunk("IHDR", struct.pack(
+                ">IIBBBBB", width, height, bit_depth, color_type, 0, 0, 0)))
+            output.write(chunk(
+                "IDAT", zlib.compress(rows.tostring(), compression_level)))
+            output.write(chunk("IEND", ""))
@@ -0,0 +1,61 @@
+""" Tests of genetic operators of populations. Run with
+'python -m unittest test_algorithm'. """
+
+import unittest
+
+import numpy
+
+from algorithm import ArrayPopulation, Genome
+
+
+class _VectorGenome(Genome):
+    """ A genome which genes are a vector of numbers in [0, 1] and which
+    score is the sum of genes """
+
+    gene_count = 3
+
+    def evaluate(self):
+        return float(self._genes.sum())
+
+    @classmethod
+    def random_genes(cls, count, random_state):
+        return random_state.rand(count, cls.gene_count)
+
+    @classmethod
+    def cross_genes(cls, first_genes, second_genes, random_state):
+        mean = (first_genes + second_genes) / 2
+        return mean, mean.copy()
+
+    @classmethod
+    def from_genes(cls, genes):
+        genome = cls()
+        genome._genes = numpy.array(genes)
+        return genome
+
+    def get_genes(self):
+        return self._genes
+
+
+class ArrayPopulationTest(unittest.TestCase):
+
+    def test_crossbreed_without_breed(self):
+        population = ArrayPopulation(_VectorGenome, 8, seed=0)
+        population.select(1.0)
+        population.crossbreed()
+        self.assertEqual(len(population.scores), 8)
+
+    def test_crossbreed_with_one_survivor(self):
+        population = ArrayPopulation(_VectorGenome, 8, seed=0)
+        population.select(0.125)
+        self.assertRaises(AssertionError, population.crossbreed)
+
+    def test_crossbreed_with_few_survivors(self):
+        for selection_rate in (0.25, 0.5):
+            population = ArrayPopulation(_VectorGenome, 8, seed=0)
+            population.select(selection_rate)
+            population.crossbreed()
+            self.assertEqual(len(population.scores), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+""" Accuracy tests of the analytic spectral engine against the FFT of
+synthesized partials. Run with 'python -m unittest test_spectrogram'. """
+
+import glob
+import os.path
+import random
+import unittest
+
+import numpy
+
+from analysis import AnalysisCache
+from pcm_audio import PcmAudio
+from sound import get_sound_factory
+from spectrogram import complex_stft, enveloped_sine_stft
+
+
+_sounds_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sounds")
+
+# The maximal error relative to the maximal magnitude of a spectrogram
+_tolerance = 1e-9
+
+
+class EnvelopedSineStftTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filenames = sorted(
+            glob.glob(os.path.join(_sounds_directory, "*.wav")))
+        self.assertTrue(self.filenames)
+
+    def get_partials(self, filename, count=8):
+        """ Returns a sound class of the sound in 'filename' and parameters
+        of 'count' partials of an initial population, which are partly
+        seeded near its spectral peaks """
+
+        random.seed(0)
+
+        sound_class = get_sound_factory(
+            PcmAudio.from_wave_file(filename), None, "band", "analytic",
+            AnalysisCache(), initialization="peaks")
+
+        return sound_class, sound_class._get_parameters(
+            sound_class.create_initial_genomes(count))
+
+    def assert_close(self, spectra, expected_spectra):
+        self.assertEqual(spectra.shape, expected_spectra.shape)
+        scale = numpy.abs(expected_spectra).max()
+        self.assertLessEqual(
+            numpy.abs(numpy.abs(spectra) - numpy.abs(expected_spectra)).max(),
+            _tolerance * scale)
+        self.assertLessEqual(
+            numpy.abs(spectra - expected_spectra).max(), _tolerance * scale)
+
+    def test_full_spectra(self):
+        for filename in self.filenames:
+            sound_class, parameters = self.get_partials(filename)
+            self.assert_close(
+                enveloped_sine_stft(
+                    *parameters, sample_period=sound_class._sample_period,
+                    sample_count=len(sound_class._sample_times)),
+                complex_stft(
+                    sound_class._synthesize(*parameters, add_base=False)))
+
+    def test_band_bins(self):
+        for filename in self.filenames:
+            sound_class, parameters = self.get_partials(filename)
+            bins = sound_class._get_band_bins(parameters[0])
+            frames = slice(1, None, 3)
+            spectra = complex_stft(
+                sound_class._synthesize(*parameters, add_base=False))[
+                    :, frames]
+            self.assert_close(
+                enveloped_sine_stft(
+                    *parameters, sample_period=sound_class._sample_period,
+                    sample_count=len(sound_class._sample_times), bins=bins,
+                    frames=frames),
+                spectra[
+                    numpy.arange(len(bins))[:, numpy.newaxis, numpy.newaxis],
+                    numpy.arange(spectra.shape[1])[:, numpy.newaxis],
+                    bins[:, numpy.newaxis, :]])
+
+    def test_partial_on_bin(self):
+        # Angles of the Dirichlet kernel are zero at the bin of the partial
+        sound_class, (frequencies, phases, times, values) = \
+            self.get_partials(self.filenames[0], 1)
+        frequencies = numpy.rint(
+            frequencies / sound_class._bin_width) * sound_class._bin_width
+        self.assert_close(
+            enveloped_sine_stft(
+                frequencies, phases, times, values,
+                sound_class._sample_period, len(sound_class._sample_times)),
+            complex_stft(sound_class._synthesize(
+                frequencies, phases, times, values, add_base=False)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import threading
+
+import numpy
+
+
+class Workspace(object):
+    """ Keeps buffers which hot paths reuse instead of allocating temporary
+    arrays on each call. A buffer is identified by a name and a type and
+    grows when a larger array is requested. Contents of an array are valid
+    only until the next request of the same buffer. """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=numpy.float64):
+        """ Returns an uninitialized C-contiguous array with the specified
+        shape and type which uses the named buffer """
+
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape))
+
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or len(buffer) < size:
+            buffer = self._buffers[(name, dtype)] = numpy.empty(size, dtype)
+
+        return buffer[:size].reshape(shape)
+
+    def clear(self):
+        self._buffers.clear()
+
+
+_thread_data = threading.local()
+
+
+def get_workspace():
+    """ Returns the workspace of the current thread, so threads of evaluators
+    don't share buffers. Worker processes have their own workspaces too. """
+    workspace = getattr(_thread_data, "workspace", None)
+    if workspace is None:
+        workspace = _thread_data.workspace = Workspace()
+    return workspace